@@ -1,5 +1,13 @@
-from quart import Quart
-from helpers.purchase import poll_ton_transactions
+import time
+from quart import Quart, g, request
+from helpers.purchase import poll_ton_transactions, poll_crypto_invoices
+from helpers.fulfillment import run_fulfillment_workers
+from helpers.notifications import run_notification_sender
+from helpers.prices import run_price_refresher, schedule_price_refresh, close_price_session
+from helpers.events import publish_status, run_status_poller
+from helpers.leader import run_as_leader, release_leadership
+from config import WEB_WORKERS
+from helpers.metrics import gauge, observe, run_loop_lag_monitor
 from routes.web import web
 from routes.api import api
 from aiocryptopay import AioCryptoPay, Networks
@@ -19,20 +27,69 @@ app.config["CRYPTO"] = AioCryptoPay(token=os.getenv("CRYPTO_TOKEN"), network=Net
 app.config["BOT"] = Bot(token=os.getenv("BOT_TOKEN"))
 app.config["DB"] = Database()
 app.config["FRAGMENT"] = FragmentService()
+app.config["DB"].add_status_listener(publish_status)  # Push-уведомления о статусе покупок
+gauge("fragment_calls_in_flight", "Выполняющиеся вызовы Fragment API", lambda: app.config["FRAGMENT"].integration.in_flight)
+gauge("fragment_calls_queued", "Вызовы Fragment API в очереди пула потоков", lambda: app.config["FRAGMENT"].integration.queued)
 
 # Регистрация blueprint'ов
 app.register_blueprint(web)
 app.register_blueprint(api, url_prefix="/api")
 
+@app.before_request
+async def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+async def record_request_duration(response):
+    """Гистограмма времени ответа по шаблону маршрута (без ID в пути)"""
+    started = g.get("request_started")
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        observe("http_request_duration_seconds", time.perf_counter() - started,
+                method=request.method, route=route, status=str(response.status_code))
+    return response
+
+_background_tasks = set()  # Фоновые задачи процесса, отменяются до закрытия базы
+
+def spawn(coro):
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+def start_background_tasks():
+    """Опросчики и рассылки; в многопроцессном запуске работают только у лидера"""
+    spawn(poll_ton_transactions())
+    spawn(poll_crypto_invoices())
+    spawn(run_fulfillment_workers())
+    spawn(app.config["FRAGMENT"].run_balance_refresher())
+    spawn(run_notification_sender())
+    spawn(run_price_refresher())
+
 @app.before_serving
 async def startup():
-    asyncio.create_task(poll_ton_transactions())
+    await app.config["DB"].connect()
+    # В каждом воркере, не только у лидера
+    spawn(run_loop_lag_monitor())
+    spawn(app.config["DB"].run_log_flusher())
+    if WEB_WORKERS > 1:
+        spawn(run_status_poller(app.config["DB"]))  # Статусы от лидера для SSE-потоков этого воркера
+    schedule_price_refresh()  # Прогрев кэша цен до первых запросов
+    spawn(run_as_leader(start_background_tasks))
 
 # Закрытие ресурсов при завершении приложения
 @app.after_serving
 async def shutdown():
+    # Задачи останавливаются раньше закрытия ресурсов, которыми они пользуются
+    for task in list(_background_tasks):
+        task.cancel()
+    await asyncio.gather(*_background_tasks, return_exceptions=True)
     await app.config["CRYPTO"].close()
     await app.config["BOT"].session.close()
+    await close_price_session()
+    await app.config["DB"].close()
+    app.config["FRAGMENT"].close()
+    release_leadership()
 
 if __name__ == "__main__":
     app.run(host="0.0.0.0", port=5000, debug=True)
\ No newline at end of file
@@ -0,0 +1,25 @@
+"""
+Перевод временных меток purchases / transaction_logs в формат ISO-8601.
+
+Запуск: python backfill_timestamps.py [--batch-size 500]
+"""
+import argparse
+import asyncio
+from database import Database
+
+async def main(batch_size: int):
+    db = Database()
+    await db.connect()
+    try:
+        converted = await db.backfill_timestamps(batch_size=batch_size)
+        for table, count in converted.items():
+            print(f"{table}: {count} строк обновлено")
+        await db.rebuild_daily_stats()
+    finally:
+        await db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Перевод временных меток в ISO-8601")
+    parser.add_argument("--batch-size", type=int, default=500, help="Количество строк в одной транзакции")
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
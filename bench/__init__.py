@@ -0,0 +1 @@
+"""Нагрузочные сценарии и заменители внешних сервисов: python -m bench"""
@@ -0,0 +1,262 @@
+"""
+Нагрузочный прогон покупки звезд против локальных заменителей внешних сервисов.
+
+Приложение поднимается целиком (before_serving, опросчики, рассылка) во
+временном каталоге с пустой базой; запросы идут через тестовый клиент Quart.
+Для каждого сценария выводятся пропускная способность, p50/p99 задержки и
+задержка event loop.
+
+Запуск: python -m bench [--scenarios statistics,prices] [--requests 500] [--json result.json]
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+from bench.fakes import BASE_SCHEMA, FakeBot, FakeCryptoPay, FakeFragmentClient, FakeUpstream
+
+REPO_ROOT = Path(__file__).resolve().parent.parent
+SCENARIOS = ("statistics", "prices", "quote", "purchases", "confirmations")
+USERS = 1000
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+class LoopLagMonitor:
+    """Замер задержки event loop: насколько позже срабатывает sleep(interval)"""
+
+    def __init__(self, interval: float = 0.01):
+        self.interval = interval
+        self.label = None
+        self.samples = {}  # {сценарий: [задержка в секундах]}
+        self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            if self.label:
+                self.samples.setdefault(self.label, []).append(loop.time() - started - self.interval)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        self._task.cancel()
+
+class Bench:
+    def __init__(self, client, app, crypto, upstream, args):
+        self.client = client
+        self.app = app
+        self.crypto = crypto
+        self.upstream = upstream
+        self.args = args
+        self.lag = LoopLagMonitor()
+        self.results = []
+        self.purchases = []  # ID покупок, созданных сценарием purchases
+        self.finished = {}  # {purchase_id: (время перехода в конечный статус, статус)}
+
+    async def drive(self, scenario: str, endpoint: str, make_request, total: int):
+        """total запросов при args.concurrency одновременных клиентах"""
+        latencies = []
+        errors = 0
+        counter = iter(range(total))
+
+        async def worker():
+            nonlocal errors
+            for i in counter:
+                started = time.perf_counter()
+                try:
+                    response = await make_request(i)
+                    if response.status_code >= 400:
+                        errors += 1
+                except Exception:
+                    errors += 1
+                latencies.append(time.perf_counter() - started)
+
+        self.lag.label = scenario
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(min(self.args.concurrency, total))))
+        elapsed = time.perf_counter() - started
+        self.lag.label = None
+        self.record(scenario, endpoint, latencies, errors, elapsed)
+
+    def record(self, scenario: str, endpoint: str, latencies: list, errors: int, elapsed: float):
+        lag = self.lag.samples.get(scenario, [])
+        self.results.append({
+            "scenario": scenario,
+            "endpoint": endpoint,
+            "requests": len(latencies),
+            "errors": errors,
+            "rps": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.50) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000,
+            "loop_lag_p99_ms": percentile(lag, 0.99) * 1000,
+            "loop_lag_max_ms": max(lag, default=0.0) * 1000
+        })
+
+    async def statistics(self):
+        """Всплеск открытий главной страницы"""
+        await self.drive("statistics", "GET /api/statistics",
+                         lambda i: self.client.get("/api/statistics"), self.args.requests)
+
+    async def prices(self):
+        """Ввод количества звезд: запрос цены на каждое нажатие клавиши"""
+        await self.drive("prices", "POST /api/prices", lambda i: self.client.post("/api/prices", json={
+            "user_id": random.randint(1, USERS),
+            "amount": random.randint(50, 5000)
+        }), self.args.requests)
+
+    async def quote(self):
+        await self.drive("quote", "POST /api/quote", lambda i: self.client.post("/api/quote", json={
+            "user_id": random.randint(1, USERS)
+        }), self.args.requests)
+
+    async def create_purchase(self, i: int):
+        user_id = random.randint(1, USERS)
+        response = await self.client.post("/api/purchase", json={
+            "amount": random.randint(50, 1000),
+            "recipient_username": f"@recipient{i}",  # Не сам покупатель: без списания бонусов
+            "currency": "USDT" if i % 2 else "TON",
+            "user_id": user_id
+        })
+        if response.status_code == 200:
+            self.purchases.append((await response.get_json())["purchase_id"])
+        return response
+
+    async def purchases_burst(self):
+        """Поток новых покупок USDT и TON"""
+        await self.drive("purchases", "POST /api/purchase", self.create_purchase, self.args.purchases)
+
+    async def confirmations(self):
+        """
+        Оплата всех созданных покупок и ожидание их завершения.
+
+        Задержка считается от оплаты до конечного статуса и включает
+        интервалы опроса TON_POLL_INTERVAL / INVOICE_POLL_INTERVAL.
+        """
+        if not self.purchases:
+            await self.purchases_burst()
+        db = self.app.config["DB"]
+        paid_at = {}
+        self.lag.label = "confirmations"
+        started = time.perf_counter()
+        for purchase_id in self.purchases:
+            purchase = await db.get_purchase_by_id(str(purchase_id))
+            if purchase["currency"] == "USDT":
+                self.crypto.pay(purchase["invoice_id"])
+            else:
+                self.upstream.add_ton_payment(purchase["comment"], purchase["price"])
+            paid_at[purchase_id] = time.perf_counter()
+        deadline = time.perf_counter() + self.args.timeout
+        while len(self.finished) < len(paid_at) and time.perf_counter() < deadline:
+            await asyncio.sleep(0.05)
+        elapsed = time.perf_counter() - started
+        self.lag.label = None
+        latencies = [self.finished[purchase_id][0] - paid for purchase_id, paid in paid_at.items() if purchase_id in self.finished]
+        # Ошибки: не завершенные к таймауту и завершенные не статусом completed
+        errors = sum(1 for purchase_id in paid_at if self.finished.get(purchase_id, (0, None))[1] != "completed")
+        self.record("confirmations", "payment -> completed", latencies, errors, elapsed)
+
+    def on_status(self, purchase_id: int, status: str, error_message: str = None):
+        if status in ("completed", "failed", "cancelled"):
+            self.finished.setdefault(int(purchase_id), (time.perf_counter(), status))
+
+    async def run(self, scenarios: list):
+        self.app.config["DB"].add_status_listener(self.on_status)
+        self.lag.start()
+        try:
+            for scenario in scenarios:
+                await getattr(self, "purchases_burst" if scenario == "purchases" else scenario)()
+        finally:
+            self.lag.stop()
+
+def prepare_database(path: str):
+    """Пустая база с USERS пользователями, у части из них есть бонусы"""
+    conn = sqlite3.connect(path)
+    conn.executescript(BASE_SCHEMA)
+    conn.executemany(
+        "INSERT INTO users (user_id, username, fullname, registration_date, last_activity) VALUES (?, ?, ?, '01.01.2025 00:00:00', '01.01.2025 00:00:00')",
+        [(user_id, f"user{user_id}", f"User {user_id}") for user_id in range(1, USERS + 1)]
+    )
+    conn.executemany(
+        "INSERT INTO bonus_balance (user_id, balance) VALUES (?, ?)",
+        [(user_id, random.choice((0, 0, 10, 250))) for user_id in range(1, USERS + 1)]
+    )
+    conn.commit()
+    conn.close()
+
+def print_report(results: list):
+    header = f"{'scenario':<14}{'endpoint':<24}{'requests':>9}{'errors':>8}{'rps':>10}{'p50 ms':>10}{'p99 ms':>10}{'lag p99':>10}{'lag max':>10}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        print(f"{r['scenario']:<14}{r['endpoint']:<24}{r['requests']:>9}{r['errors']:>8}{r['rps']:>10.1f}"
+              f"{r['p50_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['loop_lag_p99_ms']:>10.1f}{r['loop_lag_max_ms']:>10.1f}")
+
+async def main(args) -> list:
+    # Рабочий каталог приложения - временный: database.db, logs/, файл блокировки
+    sys.path.insert(0, str(REPO_ROOT))
+    workdir = tempfile.mkdtemp(prefix="stars-bench-")
+    os.chdir(workdir)
+    os.makedirs("logs")
+    os.environ.setdefault("BOT_TOKEN", "123456:bench-token")
+    os.environ.setdefault("FRAGMENT_SEED", "bench")
+    os.environ.setdefault("FRAGMENT_COOKIES", "stel_ssid=bench")
+    random.seed(args.seed)
+    prepare_database("database.db")
+
+    upstream = FakeUpstream(args.latency)
+    await upstream.start()
+
+    import app as app_module
+    import helpers.prices
+    import helpers.purchase
+    helpers.purchase.TONCENTER_API_URL = f"{upstream.url}/toncenter"
+    helpers.prices.COINGECKO_URL = f"{upstream.url}/coingecko/simple/price"
+    app = app_module.app
+    crypto = FakeCryptoPay(args.latency)
+    app.config["CRYPTO"] = crypto
+    app.config["BOT"] = FakeBot(args.latency)
+    app.config["FRAGMENT"].integration.client = FakeFragmentClient(args.latency)
+
+    try:
+        async with app.test_app() as test_app:
+            bench = Bench(test_app.test_client(), app, crypto, upstream, args)
+            await bench.run(args.scenarios)
+    finally:
+        await upstream.close()
+    return bench.results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Нагрузочный прогон покупки звезд")
+    parser.add_argument("--scenarios", type=lambda value: value.split(","), default=list(SCENARIOS),
+                        help=f"Сценарии через запятую: {','.join(SCENARIOS)}")
+    parser.add_argument("--requests", type=int, default=500, help="Запросов в сценариях statistics/prices/quote")
+    parser.add_argument("--purchases", type=int, default=100, help="Покупок в сценарии purchases")
+    parser.add_argument("--concurrency", type=int, default=50, help="Одновременных клиентов")
+    parser.add_argument("--latency", type=float, default=0.05, help="Задержка ответа заменителей внешних сервисов, с")
+    parser.add_argument("--timeout", type=float, default=60, help="Ожидание завершения оплаченных покупок, с")
+    parser.add_argument("--seed", type=int, default=1, help="Зерно генератора случайных данных")
+    parser.add_argument("--json", help="Сохранить результаты в JSON-файл для сравнения прогонов")
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"Неизвестные сценарии: {', '.join(sorted(unknown))}")
+    if args.json:
+        args.json = os.path.abspath(args.json)
+
+    results = asyncio.run(main(args))
+    print_report(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
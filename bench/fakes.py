@@ -0,0 +1,169 @@
+"""
+Локальные заменители внешних сервисов: CryptoPay, Telegram Bot, Fragment,
+Toncenter и CoinGecko. Задержка ответа задается параметром latency (секунды).
+"""
+import asyncio
+import itertools
+import time
+from dataclasses import dataclass
+from aiohttp import web
+
+# Таблицы, которые в рабочей базе создает бот; миграции Database добавляют остальное
+BASE_SCHEMA = """
+CREATE TABLE users (
+    user_id INTEGER PRIMARY KEY,
+    username TEXT,
+    fullname TEXT,
+    registration_date TEXT,
+    last_activity TEXT,
+    referrer_id INTEGER,
+    referral_level INTEGER DEFAULT 1
+);
+CREATE TABLE bonus_balance (user_id INTEGER PRIMARY KEY, balance REAL DEFAULT 0);
+CREATE TABLE referral_levels (user_id INTEGER PRIMARY KEY, level INTEGER DEFAULT 1, total_referral_stars INTEGER DEFAULT 0);
+CREATE TABLE auth_tokens (token TEXT PRIMARY KEY, user_id INTEGER, expires_at TIMESTAMP);
+CREATE TABLE purchases (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    product TEXT,
+    amount INTEGER,
+    recipient_username TEXT,
+    currency TEXT,
+    price REAL,
+    invoice_id TEXT,
+    comment TEXT,
+    status TEXT,
+    created_at TEXT,
+    updated_at TEXT,
+    fragment_transaction_id TEXT,
+    error_message TEXT,
+    bonus_stars_used REAL DEFAULT 0,
+    bonus_discount REAL DEFAULT 0
+);
+CREATE TABLE transaction_logs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    purchase_id INTEGER,
+    action TEXT,
+    status TEXT,
+    details TEXT,
+    timestamp TEXT
+);
+"""
+
+@dataclass
+class FakeInvoice:
+    invoice_id: int
+    amount: float
+    status: str = "active"
+
+    @property
+    def bot_invoice_url(self) -> str:
+        return f"https://t.me/CryptoBot?start=bench{self.invoice_id}"
+
+class FakeCryptoPay:
+    """Заменитель AioCryptoPay: инвойсы хранятся в памяти, оплата - вызов pay()"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.invoices = {}
+        self._ids = itertools.count(1)
+
+    async def create_invoice(self, asset: str, amount: float, **kwargs) -> FakeInvoice:
+        await asyncio.sleep(self.latency)
+        invoice = FakeInvoice(next(self._ids), amount)
+        self.invoices[invoice.invoice_id] = invoice
+        return invoice
+
+    async def get_invoices(self, invoice_ids=None, count=None, **kwargs) -> list:
+        await asyncio.sleep(self.latency)
+        return [self.invoices[invoice_id] for invoice_id in invoice_ids or () if invoice_id in self.invoices]
+
+    async def delete_invoice(self, invoice_id: int) -> bool:
+        await asyncio.sleep(self.latency)
+        return self.invoices.pop(invoice_id, None) is not None
+
+    def pay(self, invoice_id: int):
+        self.invoices[int(invoice_id)].status = "paid"
+
+    async def close(self):
+        pass
+
+class _FakeSession:
+    async def close(self):
+        pass
+
+class FakeBot:
+    """Заменитель aiogram Bot: считает отправленные сообщения"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.sent = 0
+        self.session = _FakeSession()
+
+    async def send_message(self, chat_id, text: str, parse_mode=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        self.sent += 1
+
+class FakeFragmentClient:
+    """Заменитель синхронного FragmentAPIClient (вызывается из пула потоков)"""
+
+    def __init__(self, latency: float, balance: float = 1_000_000.0):
+        self.latency = latency
+        self.balance = balance
+
+    def get_balance(self, seed: str) -> dict:
+        time.sleep(self.latency)
+        return {"success": True, "balance": self.balance}
+
+    def get_user_info(self, username: str, fragment_cookies: str) -> dict:
+        time.sleep(self.latency)
+        return {"username": username, "name": username}
+
+    def buy_stars_without_kyc(self, username: str, amount: int, seed: str) -> dict:
+        time.sleep(self.latency)
+        return {"success": True, "transaction_id": f"bench_{username}_{amount}"}
+
+class FakeUpstream:
+    """HTTP-заменитель Toncenter getTransactions и CoinGecko simple/price"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.transactions = []  # От новых к старым, как отдает Toncenter
+        self._lt = itertools.count(1_000_000)
+        self._runner = None
+        self.url = None
+
+    def add_ton_payment(self, comment: str, value_ton: float):
+        lt = next(self._lt)
+        self.transactions.insert(0, {
+            "transaction_id": {"lt": str(lt), "hash": f"hash{lt}"},
+            "in_msg": {"message": comment, "value": str(int(round(value_ton * 1e9)))}
+        })
+
+    async def _get_transactions(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        limit = int(request.query.get("limit", 10))
+        start = 0
+        if "lt" in request.query:
+            lts = [tx["transaction_id"]["lt"] for tx in self.transactions]
+            start = lts.index(request.query["lt"]) if request.query["lt"] in lts else len(lts)
+        return web.json_response({"ok": True, "result": self.transactions[start:start + limit]})
+
+    async def _simple_price(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.latency)
+        return web.json_response({"the-open-network": {"rub": 250.0}, "tether": {"rub": 95.0}})
+
+    async def start(self):
+        app = web.Application()
+        app.router.add_get("/toncenter/getTransactions", self._get_transactions)
+        app.router.add_get("/coingecko/simple/price", self._simple_price)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, "127.0.0.1", 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.url = f"http://127.0.0.1:{port}"
+
+    async def close(self):
+        if self._runner:
+            await self._runner.cleanup()
@@ -1,6 +1,4 @@
-import aiohttp
 import logging
-from datetime import datetime
 import os
 from dotenv import load_dotenv
 
@@ -14,54 +12,49 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-_star_prices_cache = {
-    "prices": {"TON": 0.0057, "USDT": 0.017},  # Запасные значения по умолчанию
-    "last_updated": None  # Время последнего обновления
-}
-CACHE_TTL = 300  # Время жизни кэша в секундах (5 минут)
-
-async def get_star_prices() -> dict:
-    """Получение текущей стоимости 1 звезды в TON и USDT, эквивалентной 1.38 RUB"""
-    STAR_PRICE_RUB = 1.38  # Цена 1 звезды в RUB
-    current_time = datetime.utcnow()
-
-    # Проверяем, есть ли актуальный кэш
-    if (
-        _star_prices_cache["last_updated"]
-        and (current_time - _star_prices_cache["last_updated"]).total_seconds() < CACHE_TTL
-    ):
-        logger.info("Возвращены кэшированные цены звезд")
-        return _star_prices_cache["prices"]
-
-    try:
-        async with aiohttp.ClientSession() as session:
-            url = "https://api.coingecko.com/api/v3/simple/price?ids=the-open-network,tether&vs_currencies=rub"
-            async with session.get(url) as response:
-                if response.status != 200:
-                    logger.error(f"Ошибка API CoinGecko: статус {response.status}")
-                    return _star_prices_cache["prices"]  # Возвращаем кэш при ошибке
-                data = await response.json()
-                ton_rub = data.get("the-open-network", {}).get("rub", 0)
-                usdt_rub = data.get("tether", {}).get("rub", 0)
-                if ton_rub == 0 or usdt_rub == 0:
-                    logger.error("Ошибка: нулевые курсы TON или USDT")
-                    return _star_prices_cache["prices"]  # Возвращаем кэш при ошибке
-                prices = {
-                    "TON": STAR_PRICE_RUB / ton_rub,  # Кол-во TON за 1.38 RUB
-                    "USDT": STAR_PRICE_RUB / usdt_rub  # Кол-во USDT за 1.38 RUB
-                }
-                # Обновляем кэш
-                _star_prices_cache["prices"] = prices
-                _star_prices_cache["last_updated"] = current_time
-                logger.info("Цены звезд успешно обновлены и закэшированы")
-                return prices
-    except Exception as e:
-        logger.error(f"Ошибка при получении курсов через CoinGecko: {e}")
-        return _star_prices_cache["prices"]  # Возвращаем кэш при ошибке
-
 MIN_STARS_AMOUNT = 50
 
+WEB_BIND = os.getenv("WEB_BIND", "0.0.0.0:5000")  # Адрес production-сервера (serve.py)
+WEB_WORKERS = int(os.getenv("WEB_WORKERS", 1))  # Процессов Hypercorn; по умолчанию одно ядро
+
+PRICES_TTL = 300  # Время, после которого цены звезд считаются устаревшими, в секундах
+PRICES_REFRESH_INTERVAL = 240  # Период фонового обновления цен (раньше истечения PRICES_TTL)
+PRICES_REQUEST_TIMEOUT = 10  # Таймаут запроса к CoinGecko в секундах
+PRICES_RETRY_BACKOFF = 30  # Пока цены не получены: после неудачи столько секунд отдаются запасные цены без ожидания
+QUOTE_TTL = 120  # Срок действия котировки /api/quote, в секундах
+
 DATABASE_PATH = "database.db"
+LEADER_LOCK_PATH = "pollers.lock"  # Файловая блокировка: фоновые задачи запускает только владелец
+LEADER_RETRY_INTERVAL = 30  # Период попыток захвата блокировки остальными воркерами, в секундах
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 4))  # Количество соединений для чтения
+DB_BUSY_TIMEOUT_MS = 5000  # Ожидание блокировки SQLite другим процессом (бот)
+TRANSACTION_LOG_FLUSH_INTERVAL = 0.2  # Период записи буфера transaction_logs в базу, в секундах
+TRANSACTION_LOG_BATCH_SIZE = 200  # Строк в буфере, при которых запись начинается не дожидаясь периода
+USER_CACHE_TTL = 30  # Время жизни профиля пользователя в кэше, в секундах
+USER_CACHE_SIZE = 5000  # Количество профилей в кэше
+
+# Уровни реферальной программы: (уровень, порог звезд рефералов, доля вознаграждения)
+REFERRAL_LEVELS = (
+    (1, 0, 0.02),
+    (2, 5000, 0.04),
+    (3, 10000, 0.06),
+    (4, 15000, 0.08),
+    (5, 20000, 0.10),
+)
+
+INIT_DATA_TTL = 24 * 60 * 60  # Срок действия initData Telegram с момента auth_date, в секундах
+INIT_DATA_CACHE_SIZE = 10000  # Количество проверенных initData в кэше
+
+STATISTICS_CACHE_TTL = 30  # Время жизни кэша /api/statistics в секундах
+TRUST_PROXY_HEADERS = os.getenv("TRUST_PROXY_HEADERS", "1") == "1"  # IP клиента из X-Forwarded-For обратного прокси
+RATE_LIMIT_MAX_CLIENTS = 10000  # Счетчиков ограничения запросов в памяти, после - удаление истекших
+PURCHASES_PAGE_SIZE = 20  # Покупок на странице /api/purchases по умолчанию
+PURCHASES_PAGE_MAX = 100  # Предел параметра limit в /api/purchases
+
+NOTIFY_BATCH_SIZE = 100  # Сообщений, выбираемых из outbox за один проход
+NOTIFY_GLOBAL_RATE = 25  # Максимум сообщений в секунду по всем чатам (лимит Telegram - 30)
+NOTIFY_CHAT_INTERVAL = 1.0  # Минимальный интервал между сообщениями в один чат в секундах
+NOTIFY_MAX_ATTEMPTS = 8  # Попыток отправки до удаления сообщения из очереди
 
 CHAT_ID = -1002800830097 # ID канала для проверки подписки
 CHANNEL_LINK = "https://t.me/+WKWn3RpfKKEwMWFi"  # линк на канал для доступа к боту
@@ -70,9 +63,42 @@ ADMIN_ID = ['1384040605']
 
 TON_WALLET_ADDRESS = '0QCzH0vnl-glR5XORGbJ3DCCXVMn_vBbEd6RS2InrWupf7OD'
 TONCENTER_API_KEY = os.getenv("TONCENTER_API_KEY")
+TONCENTER_API_URL = "https://testnet.toncenter.com/api/v2"
+TON_POLL_INTERVAL = 5  # Интервал опроса транзакций кошелька в секундах
+TON_TRANSACTIONS_PAGE = 50  # Транзакций в одном запросе getTransactions
+TON_MAX_PAGES = 40  # Предел страниц за один проход (защита от бесконечного листания)
+
+INVOICE_TTL = 15 * 60  # Время жизни неоплаченного счета в секундах
+INVOICE_POLL_INTERVAL = 5  # Интервал опроса CryptoPay в секундах
+CRYPTO_INVOICES_CHUNK = 100  # Максимум инвойсов в одном запросе getInvoices
+QR_WORKERS = 2  # Потоков для отрисовки QR-кодов
+EVENTS_KEEPALIVE = 15  # Интервал keep-alive комментариев в потоке статуса покупки, в секундах
+EVENTS_RESYNC_INTERVAL = 2  # При WEB_WORKERS > 1: период опроса статусов подписанных покупок из БД (их меняет лидер), в секундах
+METRICS_LOOP_LAG_INTERVAL = 0.5  # Период замера задержки event loop для /metrics, в секундах
 
 STAR_PRICE_RUB = 1.69
 
 FRAGMENT_STAR_PRICE_TON = 0.004188
+FRAGMENT_MAX_WORKERS = int(os.getenv("FRAGMENT_MAX_WORKERS", 4))  # Одновременных вызовов Fragment API
+FRAGMENT_BUY_TIMEOUT = 120  # Таймаут покупки звезд в секундах
+FRAGMENT_BALANCE_TIMEOUT = 15  # Таймаут запроса баланса в секундах
+FRAGMENT_BALANCE_TTL = 60  # Период фонового обновления кэша баланса в секундах
+FRAGMENT_LOW_BALANCE_TON = 5.0  # Порог предупреждения о заканчивающемся балансе
+FRAGMENT_LOOKUP_TIMEOUT = 10  # Таймаут проверки получателя в секундах
+FRAGMENT_LOOKUP_WORKERS = 2  # Потоков для проверок получателей (отдельно от покупок)
+RECIPIENT_RATE_LIMIT = 30  # Проверок получателя с одного IP за RECIPIENT_RATE_WINDOW
+RECIPIENT_RATE_WINDOW = 60  # Окно ограничения проверок получателя, в секундах
+RECIPIENT_CACHE_TTL = 60 * 60  # Время жизни найденного получателя в кэше, в секундах
+RECIPIENT_NEGATIVE_TTL = 5 * 60  # Время жизни "не найден" в кэше (username могут занять)
+RECIPIENT_CACHE_SIZE = 10000  # Количество получателей в кэше
+FRAGMENT_COALESCE_WINDOW = float(os.getenv("FRAGMENT_COALESCE_WINDOW", 2))  # Окно объединения заказов одному получателю, с (0 - выключено)
+
+# Одновременных доставок; ожидание в окне объединения не занимает поток Fragment
+FULFILLMENT_WORKERS = int(os.getenv("FULFILLMENT_WORKERS", FRAGMENT_MAX_WORKERS * 4))
+# Аренда задания доставки: окно объединения + общая покупка + разбиение на одиночные + запас
+FULFILLMENT_LEASE = FRAGMENT_COALESCE_WINDOW + 2 * FRAGMENT_BUY_TIMEOUT + 60
+FULFILLMENT_MAX_ATTEMPTS = 5  # Попыток обработки задания до перевода заказа в failed
+FULFILLMENT_RETRY_DELAY = 5  # Базовая задержка повтора в секундах, удваивается с каждой попыткой
+FULFILLMENT_POLL_INTERVAL = 1  # Период проверки очереди, если других воркеров не будит уведомление
 
 SUPPORTED_CURRENCIES = ["USDT", "TON", "RUB"]
\ No newline at end of file
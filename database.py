@@ -1,18 +1,389 @@
 import aiosqlite
+import asyncio
+import contextvars
 import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
+from config import DATABASE_PATH, DB_READ_POOL_SIZE, DB_BUSY_TIMEOUT_MS, USER_CACHE_TTL, USER_CACHE_SIZE, TRANSACTION_LOG_FLUSH_INTERVAL, TRANSACTION_LOG_BATCH_SIZE
+from helpers.metrics import instrument_methods
 
 logging.basicConfig(filename="logs/site.log", level=logging.INFO)
 
+TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"  # ISO-8601: строки сортируются хронологически
+LEGACY_TIMESTAMP_LIKE = "__.__.____ __:__:__"  # Старый формат "%d.%m.%Y %H:%M:%S"
+
+def msk_now() -> datetime:
+    """Текущее московское время"""
+    return datetime.utcnow() + timedelta(hours=3)
+
+def timestamp(dt: datetime = None) -> str:
+    """Строка времени для хранения в БД (по умолчанию текущее московское время)"""
+    return (dt or msk_now()).strftime(TIMESTAMP_FORMAT)
+
+def day_of(value: str) -> str:
+    """Дата "ГГГГ-ММ-ДД" из временной метки в новом или старом формате"""
+    if value and value[2:3] == ".":
+        return datetime.strptime(value[:10], "%d.%m.%Y").strftime("%Y-%m-%d")
+    return value[:10] if value else timestamp()[:10]
+
+def _legacy_to_iso(column: str) -> str:
+    """SQL-выражение, переводящее значение колонки из старого формата в ISO-8601"""
+    return (
+        f"CASE WHEN {column} LIKE '{LEGACY_TIMESTAMP_LIKE}' "
+        f"THEN substr({column}, 7, 4) || '-' || substr({column}, 4, 2) || '-' || substr({column}, 1, 2) || substr({column}, 11) "
+        f"ELSE {column} END"
+    )
+
+def _level_case(expression: str, levels: tuple) -> str:
+    """SQL-выражение реферального уровня по порогам ((уровень, порог звезд), ...)"""
+    cases = " ".join(
+        f"WHEN {expression} >= {int(threshold)} THEN {int(level)}"
+        for level, threshold in sorted(levels, key=lambda item: item[1], reverse=True)
+    )
+    return f"CASE {cases} ELSE 1 END"
+
+# Пересчет суточных итогов по всем завершенным покупкам
+REBUILD_DAILY_STATS = (
+    "DELETE FROM stars_daily_stats",
+    f"""
+    INSERT INTO stars_daily_stats (day, stars)
+    SELECT substr({_legacy_to_iso("created_at")}, 1, 10), SUM(amount) FROM purchases
+    WHERE status = 'completed' GROUP BY 1
+    """,
+)
+
+# Миграции схемы, применяются по порядку согласно PRAGMA user_version
+MIGRATIONS = (
+    (
+        "CREATE INDEX IF NOT EXISTS idx_purchases_status_created_at ON purchases (status, created_at)",
+    ),
+    (
+        # Суточные итоги отправленных звезд, обновляются при переходе покупки в completed
+        """
+        CREATE TABLE IF NOT EXISTS stars_daily_stats (
+            day TEXT PRIMARY KEY,
+            stars INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        *REBUILD_DAILY_STATS,
+    ),
+    (
+        # Позиция фоновых опросчиков (последняя обработанная транзакция)
+        """
+        CREATE TABLE IF NOT EXISTS poller_cursors (
+            name TEXT PRIMARY KEY,
+            lt INTEGER NOT NULL,
+            hash TEXT NOT NULL
+        )
+        """,
+    ),
+    (
+        # Очередь исходящих сообщений Telegram (outbox)
+        """
+        CREATE TABLE IF NOT EXISTS notifications (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            chat_id INTEGER NOT NULL,
+            text TEXT NOT NULL,
+            parse_mode TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at REAL NOT NULL,
+            last_error TEXT,
+            created_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_notifications_next_attempt_at ON notifications (next_attempt_at)",
+    ),
+    (
+        # Журнал изменений бонусного баланса: amount - запрошенное изменение,
+        # balance_after - баланс после применения max(0, balance + amount)
+        """
+        CREATE TABLE IF NOT EXISTS bonus_ledger (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            amount REAL NOT NULL,
+            balance_after REAL NOT NULL,
+            reason TEXT,
+            purchase_id INTEGER,
+            created_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_bonus_ledger_user_id ON bonus_ledger (user_id, id)",
+        # Начальные остатки, чтобы журнал сходился с текущими балансами
+        """
+        INSERT INTO bonus_ledger (user_id, amount, balance_after, reason, created_at)
+        SELECT user_id, balance, balance, 'opening_balance', strftime('%Y-%m-%d %H:%M:%S', 'now', '+3 hours')
+        FROM bonus_balance b WHERE balance > 0 AND NOT EXISTS (
+            SELECT 1 FROM bonus_ledger l WHERE l.reason = 'opening_balance' AND l.user_id = b.user_id
+        )
+        """,
+    ),
+    (
+        # Очередь доставки оплаченных заказов. stage: queued - Fragment еще не вызывался,
+        # ready - бонусы списаны, Fragment отказал до отправки, delivering - вызов мог
+        # состояться, delivered - звезды отправлены, осталось завершить заказ
+        """
+        CREATE TABLE IF NOT EXISTS fulfillment_jobs (
+            purchase_id INTEGER PRIMARY KEY,
+            stage TEXT NOT NULL DEFAULT 'queued',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            run_at REAL NOT NULL,
+            locked_until REAL,
+            transaction_id TEXT,
+            last_error TEXT,
+            created_at TEXT NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_fulfillment_jobs_run_at ON fulfillment_jobs (run_at)",
+    ),
+    (
+        # Покрывающий индекс истории покупок: страница читается из индекса без обращения к таблице
+        """
+        CREATE INDEX IF NOT EXISTS idx_purchases_user_id ON purchases
+        (user_id, id DESC, amount, recipient_username, currency, price, status, created_at)
+        """,
+    ),
+)
+
+_current_transaction = contextvars.ContextVar("current_transaction", default=None)
+
+# PRAGMA, которые выставляются один раз на каждое соединение пула
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    f"PRAGMA busy_timeout = {DB_BUSY_TIMEOUT_MS}",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 134217728",
+)
+
 class Database:
-    def __init__(self):
-        self.db_name = "database.db"
+    def __init__(self, db_name: str = DATABASE_PATH, read_pool_size: int = DB_READ_POOL_SIZE):
+        self.db_name = db_name
+        self.read_pool_size = read_pool_size
+        self._writer = None  # Единственное соединение для записи
+        self._readers = asyncio.Queue()  # Пул соединений для чтения
+        self._reader_conns = []
+        self._write_lock = asyncio.Lock()
+        self._connect_lock = asyncio.Lock()
+        self._status_listeners = []  # Вызываются после фиксации нового статуса покупки
+        self._profiles = OrderedDict()  # LRU-кэш профилей: {user_id: (профиль, срок действия)}
+        self._profiles_generation = 0  # Растет при каждой инвалидации, защищает от записи устаревшего профиля
+        self._log_buffer = []  # Строки transaction_logs, ожидающие записи пачкой
+        self._log_flush_needed = asyncio.Event()  # Буфер достиг TRANSACTION_LOG_BATCH_SIZE
+        self._log_flush_lock = asyncio.Lock()  # Пачки пишутся по очереди, порядок строк сохраняется
+
+    async def _open_connection(self, readonly: bool) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_name)
+        conn.row_factory = aiosqlite.Row
+        for pragma in CONNECTION_PRAGMAS:
+            await conn.execute(pragma)
+        if readonly:
+            await conn.execute("PRAGMA query_only = ON")
+        return conn
+
+    async def connect(self):
+        """Открытие пула соединений (вызывается в before_serving)"""
+        async with self._connect_lock:
+            if self._writer is not None:
+                return
+            writer = await self._open_connection(readonly=False)
+            await writer.execute("PRAGMA journal_mode = WAL")
+            await writer.commit()
+            await self._migrate(writer)
+            for _ in range(self.read_pool_size):
+                conn = await self._open_connection(readonly=True)
+                self._reader_conns.append(conn)
+                self._readers.put_nowait(conn)
+            self._writer = writer
+            logging.info(f"Database pool opened: 1 writer, {self.read_pool_size} readers ({self.db_name})")
+
+    async def _migrate(self, conn: aiosqlite.Connection):
+        """
+        Применение недостающих миграций схемы.
+
+        Воркеры Hypercorn стартуют одновременно, поэтому каждая миграция
+        выполняется под BEGIN IMMEDIATE, а user_version перечитывается внутри
+        транзакции: миграцию, примененную другим процессом, повторно не выполняем.
+        """
+        while True:
+            try:
+                await conn.execute("BEGIN IMMEDIATE")
+            except sqlite3.OperationalError as e:
+                if "locked" not in str(e):
+                    raise
+                await asyncio.sleep(0.1)  # Другой воркер дольше DB_BUSY_TIMEOUT_MS применяет миграцию
+                continue
+            try:
+                cursor = await conn.execute("PRAGMA user_version")
+                version = (await cursor.fetchone())[0]
+                if version >= len(MIGRATIONS):
+                    await conn.commit()
+                    return
+                for statement in MIGRATIONS[version]:
+                    await conn.execute(statement)
+                await conn.execute(f"PRAGMA user_version = {version + 1}")
+                await conn.commit()
+            except BaseException:
+                await conn.rollback()
+                raise
+            logging.info(f"Database migration {version + 1} applied")
+
+    async def close(self):
+        """Закрытие пула соединений (вызывается в after_serving); буфер журнала записывается перед закрытием"""
+        async with self._connect_lock:
+            if self._writer is None:
+                return
+            try:
+                await self.flush_transaction_logs()
+            except Exception as e:
+                logging.error(f"Transaction log: {len(self._log_buffer)} rows lost on shutdown: {str(e)}")
+            async with self._write_lock:
+                await self._writer.close()
+                self._writer = None
+            for conn in self._reader_conns:
+                await conn.close()
+            self._reader_conns.clear()
+            self._readers = asyncio.Queue()
+
+    def _active_transaction(self):
+        """Открытая транзакция текущей задачи (дочерние задачи ее не наследуют)"""
+        transaction = _current_transaction.get()
+        if transaction and transaction["db"] is self and transaction["task"] is asyncio.current_task():
+            return transaction
+        return None
+
+    @asynccontextmanager
+    async def _read(self):
+        """Соединение из пула читателей (внутри транзакции - соединение писателя)"""
+        if self._active_transaction():
+            yield self._writer
+            return
+        if self._writer is None:
+            await self.connect()
+        conn = await self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def _write(self):
+        """Соединение писателя: запись сериализуется, commit при успехе, rollback при ошибке"""
+        if self._active_transaction():
+            yield self._writer  # Фиксация - при выходе из transaction()
+            return
+        if self._writer is None:
+            await self.connect()
+        async with self._write_lock:
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Единица работы: все вызовы методов Database внутри блока выполняются
+        на соединении писателя и фиксируются одним commit (или откатываются
+        целиком при исключении). Вложенный вызов присоединяется к внешней
+        транзакции. Внутри блока не стоит ждать сеть: запись остальных
+        задач ждет его завершения.
+        """
+        if self._active_transaction():
+            yield self
+            return
+        if self._writer is None:
+            await self.connect()
+        async with self._write_lock:
+            transaction = {"db": self, "task": asyncio.current_task(), "statuses": [], "profiles": set(), "logs": []}
+            token = _current_transaction.set(transaction)
+            try:
+                yield self
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                raise
+            finally:
+                _current_transaction.reset(token)
+        # Журнал пишется только для зафиксированных изменений
+        self._buffer_logs(transaction["logs"])
+        # Профили, прочитанные параллельно до фиксации, могли попасть в кэш
+        for user_id in transaction["profiles"]:
+            self._invalidate_profile(user_id)
+        # Подписчики узнают о новых статусах только после фиксации
+        for status in transaction["statuses"]:
+            self._notify_status(*status)
+
+    def add_status_listener(self, listener):
+        """Подписка на изменения статуса покупок: listener(purchase_id, status, error_message)"""
+        self._status_listeners.append(listener)
+
+    def _notify_status(self, purchase_id: int, status: str, error_message: str = None):
+        transaction = self._active_transaction()
+        if transaction:
+            transaction["statuses"].append((purchase_id, status, error_message))
+            return
+        for listener in self._status_listeners:
+            try:
+                listener(purchase_id, status, error_message)
+            except Exception as e:
+                logging.error(f"Status listener failed for purchase {purchase_id}: {str(e)}")
+
+    def _invalidate_profile(self, user_id: int = None):
+        """Удаление профиля из кэша (без user_id - очистка всего кэша)"""
+        self._profiles_generation += 1
+        if user_id is None:
+            self._profiles.clear()
+            return
+        self._profiles.pop(user_id, None)
+        transaction = self._active_transaction()
+        if transaction:
+            transaction["profiles"].add(user_id)
+
+    async def get_user_profile(self, user_id: int, fresh: bool = False):
+        """
+        Пользователь, его реферальный уровень и бонусный баланс одним запросом.
+
+        Результат кэшируется на USER_CACHE_TTL секунд (до USER_CACHE_SIZE
+        пользователей) и сбрасывается методами записи этого процесса. Внутри
+        транзакции и с fresh=True кэш не читается: баланс мог изменить другой
+        процесс (лидер или бот).
+        """
+        in_transaction = self._active_transaction() is not None
+        if not in_transaction and not fresh:
+            cached = self._profiles.get(user_id)
+            if cached and time.monotonic() < cached[1]:
+                self._profiles.move_to_end(user_id)
+                return dict(cached[0]) if cached[0] else None
+        generation = self._profiles_generation
+        try:
+            async with self._read() as db:
+                cursor = await db.execute("""
+                    SELECT u.*, r.level, r.total_referral_stars, COALESCE(b.balance, 0) AS bonus_balance
+                    FROM users u
+                    LEFT JOIN referral_levels r ON u.user_id = r.user_id
+                    LEFT JOIN bonus_balance b ON u.user_id = b.user_id
+                    WHERE u.user_id = ?
+                """, (user_id,))
+                row = await cursor.fetchone()
+        except Exception as e:
+            return None
+        profile = dict(row) if row else None
+        if not in_transaction and generation == self._profiles_generation:
+            self._profiles[user_id] = (profile, time.monotonic() + USER_CACHE_TTL)
+            if len(self._profiles) > USER_CACHE_SIZE:
+                self._profiles.popitem(last=False)
+        return dict(profile) if profile else None
 
     async def create_user(self, user_id: int, username: str, fullname: str, referrer_id: int = None) -> bool:
         """Добавление пользователя в базу данных"""
         try:
             msk_time = (datetime.utcnow() + timedelta(hours=3)).strftime("%d.%m.%Y %H:%M:%S")
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self._write() as db:
                 await db.execute("""
                     INSERT INTO users (user_id, username, fullname, registration_date, last_activity, referrer_id, referral_level)
                     VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP, ?, 1)
@@ -25,29 +396,20 @@ class Database:
                     INSERT INTO referral_levels (user_id, level, total_referral_stars)
                     VALUES (?, 1, 0)
                 """, (user_id,))
-                await db.commit()
-                return True
+            self._invalidate_profile(user_id)
+            return True
         except Exception as e:
             return False
 
     async def get_user(self, user_id: int):
-        """Получение информации о пользователе"""
-        try:
-            async with aiosqlite.connect(self.db_name) as db:
-                db.row_factory = aiosqlite.Row
-                cursor = await db.execute("""
-                    SELECT u.*, r.level, r.total_referral_stars 
-                    FROM users u 
-                    LEFT JOIN referral_levels r ON u.user_id = r.user_id 
-                    WHERE u.user_id = ?
-                """, (user_id,))
-                row = await cursor.fetchone()
-                return dict(row) if row else None
-        except Exception as e:
-            return None
+        """Получение информации о пользователе (из кэша профилей)"""
+        return await self.get_user_profile(user_id)
 
     async def get_bonus_balance(self, user_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        profile = await self.get_user_profile(user_id)
+        if profile:
+            return profile["bonus_balance"]
+        async with self._read() as db:
             cursor = await db.execute("SELECT balance FROM bonus_balance WHERE user_id = ?", (user_id,))
             result = await cursor.fetchone()
             return result[0] if result else 0
@@ -55,7 +417,7 @@ class Database:
     async def get_total_referral_stars(self, user_id: int) -> int:
         """Получить общее количество звезд, купленных рефералами"""
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self._read() as db:
                 cursor = await db.execute("""
                     SELECT total_referral_stars FROM referral_levels WHERE user_id = ?
                 """, (user_id,))
@@ -64,21 +426,98 @@ class Database:
         except Exception as e:
             return 0
 
-    async def update_bonus_balance(self, user_id: int, amount: float):
-        async with aiosqlite.connect(self.db_name) as db:
-            current_balance = await self.get_bonus_balance(user_id)
-            new_balance = max(0, current_balance + amount)  # Не допускаем отрицательный баланс
+    async def update_bonus_balance(self, user_id: int, amount: float, reason: str = None, purchase_id: int = None) -> float:
+        """Атомарное изменение бонусного баланса (не ниже нуля) с записью в bonus_ledger"""
+        async with self._write() as db:
+            cursor = await db.execute(
+                "UPDATE bonus_balance SET balance = max(0, balance + ?) WHERE user_id = ? RETURNING balance",
+                (amount, user_id)
+            )
+            row = await cursor.fetchone()
+            if row:
+                new_balance = row[0]
+            else:
+                new_balance = max(0, amount)  # Не допускаем отрицательный баланс
+                await db.execute("INSERT INTO bonus_balance (user_id, balance) VALUES (?, ?)", (user_id, new_balance))
+            await db.execute(
+                "INSERT INTO bonus_ledger (user_id, amount, balance_after, reason, purchase_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, amount, new_balance, reason, purchase_id, timestamp())
+            )
+        self._invalidate_profile(user_id)
+        return new_balance
+
+    async def spend_bonus_balance(self, user_id: int, amount: float, reason: str = None, purchase_id: int = None) -> bool:
+        """Списание бонусов, только если их хватает; False - баланс меньше amount, ничего не списано"""
+        async with self._write() as db:
+            cursor = await db.execute(
+                "UPDATE bonus_balance SET balance = max(0, balance - ?1) WHERE user_id = ?2 AND balance >= ?1 - 1e-9 RETURNING balance",
+                (amount, user_id)
+            )
+            row = await cursor.fetchone()
+            if not row:
+                return False
             await db.execute(
-                "INSERT OR REPLACE INTO bonus_balance (user_id, balance) VALUES (?, ?)",
-                (user_id, new_balance)
+                "INSERT INTO bonus_ledger (user_id, amount, balance_after, reason, purchase_id, created_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (user_id, -amount, row[0], reason, purchase_id, timestamp())
             )
-            await db.commit()
-            return new_balance
-        
+        self._invalidate_profile(user_id)
+        return True
+
+    async def reconcile_bonus_balances(self, batch_size: int = 500) -> int:
+        """
+        Пересчет бонусных балансов из bonus_ledger.
+
+        Балансы и журнал читаются из одного снимка базы, изменения журнала
+        применяются по тому же правилу max(0, balance + amount). Расхождения
+        исправляются пачками условным UPDATE: если баланс изменился после
+        чтения (бот или сайт начислили/списали), строка пропускается до
+        следующего запуска. Возвращается количество исправленных пользователей.
+        """
+        async with self._read() as db:
+            await db.execute("BEGIN")  # Один снимок для баланса и журнала
+            try:
+                cursor = await db.execute("SELECT user_id, balance FROM bonus_balance")
+                current = {row[0]: row[1] for row in await cursor.fetchall()}
+                cursor = await db.execute("SELECT user_id, amount FROM bonus_ledger ORDER BY user_id, id")
+                expected = {}
+                for user_id, amount in await cursor.fetchall():
+                    expected[user_id] = max(0, expected.get(user_id, 0) + amount)
+            finally:
+                await db.execute("COMMIT")
+        fixes = [
+            (user_id, balance) for user_id, balance in expected.items()
+            if abs(current.get(user_id, 0) - balance) > 1e-9
+        ]
+        fixed, skipped = [], 0
+        for start in range(0, len(fixes), batch_size):
+            async with self._write() as db:
+                for user_id, balance in fixes[start:start + batch_size]:
+                    if user_id in current:
+                        cursor = await db.execute(
+                            "UPDATE bonus_balance SET balance = ? WHERE user_id = ? AND balance = ?",
+                            (balance, user_id, current[user_id])
+                        )
+                    else:
+                        cursor = await db.execute(
+                            "INSERT OR IGNORE INTO bonus_balance (user_id, balance) VALUES (?, ?)",
+                            (user_id, balance)
+                        )
+                    if cursor.rowcount:
+                        fixed.append((user_id, balance))
+                    else:
+                        skipped += 1
+        if fixed:
+            self._invalidate_profile()
+        for user_id, balance in fixed:
+            logging.warning(f"Bonus balance reconciled: user {user_id} {current.get(user_id, 0)} -> {balance}")
+        if skipped:
+            logging.warning(f"Bonus balance reconcile: {skipped} balances changed during the run, skipped")
+        return len(fixed)
+
     async def update_referral_level(self, user_id: int, level: int, total_referral_stars: int) -> bool:
         """Обновление уровня реферальной системы и количества звезд рефералов"""
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            async with self._write() as db:
                 await db.execute("""
                     INSERT OR REPLACE INTO referral_levels (user_id, level, total_referral_stars)
                     VALUES (?, ?, ?)
@@ -86,37 +525,97 @@ class Database:
                 await db.execute("""
                     UPDATE users SET referral_level = ? WHERE user_id = ?
                 """, (level, user_id))
-                await db.commit()
-                return True
+            self._invalidate_profile(user_id)
+            return True
         except Exception as e:
             return False
 
+    async def get_referral_info(self, user_id: int):
+        """ID реферера покупателя и username покупателя; None, если реферера нет в users"""
+        async with self._read() as db:
+            cursor = await db.execute(
+                """
+                SELECT u.referrer_id, u.username FROM users u
+                JOIN users r ON r.user_id = u.referrer_id
+                WHERE u.user_id = ?
+                """,
+                (user_id,)
+            )
+            row = await cursor.fetchone()
+            return dict(row) if row and row["referrer_id"] else None
+
+    async def add_referral_stars(self, referrer_id: int, stars: int, levels: tuple) -> dict:
+        """
+        Добавление звезд рефералов одним upsert: новый накопленный итог и уровень
+        по порогам levels ((уровень, порог), ...) вычисляются в SQL.
+        """
+        async with self._write() as db:
+            cursor = await db.execute(
+                f"""
+                INSERT INTO referral_levels (user_id, level, total_referral_stars)
+                VALUES (?1, {_level_case("?2", levels)}, ?2)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    total_referral_stars = referral_levels.total_referral_stars + excluded.total_referral_stars,
+                    level = {_level_case("(referral_levels.total_referral_stars + excluded.total_referral_stars)", levels)}
+                RETURNING level, total_referral_stars
+                """,
+                (referrer_id, stars)
+            )
+            row = await cursor.fetchone()
+            await db.execute("UPDATE users SET referral_level = ? WHERE user_id = ? AND referral_level != ?", (row[0], referrer_id, row[0]))
+        self._invalidate_profile(referrer_id)
+        return {"level": row[0], "total_referral_stars": row[1]}
+
+    async def rebuild_referral_levels(self, levels: tuple) -> int:
+        """Пересчет referral_levels всех пользователей по завершенным покупкам рефералов одним проходом"""
+        async with self._write() as db:
+            await db.execute("UPDATE referral_levels SET total_referral_stars = 0")
+            cursor = await db.execute(
+                """
+                INSERT INTO referral_levels (user_id, level, total_referral_stars)
+                SELECT u.referrer_id, 1, SUM(p.amount) FROM purchases p
+                JOIN users u ON u.user_id = p.user_id
+                JOIN users r ON r.user_id = u.referrer_id
+                WHERE p.status = 'completed' AND u.referrer_id IS NOT NULL
+                GROUP BY u.referrer_id
+                ON CONFLICT(user_id) DO UPDATE SET total_referral_stars = excluded.total_referral_stars
+                """
+            )
+            updated = cursor.rowcount
+            await db.execute(f"UPDATE referral_levels SET level = {_level_case('total_referral_stars', levels)}")
+            await db.execute(
+                """
+                UPDATE users SET referral_level = (SELECT level FROM referral_levels r WHERE r.user_id = users.user_id)
+                WHERE user_id IN (SELECT user_id FROM referral_levels)
+                """
+            )
+        self._invalidate_profile()
+        return updated
+
     async def get_referrer_id(self, user_id: int):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._read() as db:
             cursor = await db.execute("SELECT referrer_id FROM users WHERE user_id = ?", (user_id,))
             result = await cursor.fetchone()
             return result[0] if result and result[0] else None
 
     async def create_purchase(self, user_id: int, item_type: str, amount: int, recipient_username: str, currency: str, price: float, invoice_id: str, bonus_stars_used: float = 0.0, bonus_discount: float = 0.0, comment: str = None):
-        async with aiosqlite.connect(self.db_name) as db:
-            await db.execute(
+        async with self._write() as db:
+            cursor = await db.execute(
                 """
                 INSERT INTO purchases (user_id, product, amount, recipient_username, currency, price, invoice_id, comment, status, created_at, updated_at, bonus_stars_used, bonus_discount)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
                 """,
-                (user_id, item_type, amount, recipient_username, currency, price, invoice_id, comment, "pending", (datetime.utcnow() + timedelta(hours=3)).strftime("%d.%m.%Y %H:%M:%S"), (datetime.utcnow() + timedelta(hours=3)).strftime("%d.%m.%Y %H:%M:%S"), bonus_stars_used, bonus_discount)
+                (user_id, item_type, amount, recipient_username, currency, price, invoice_id, comment, "pending", timestamp(), timestamp(), bonus_stars_used, bonus_discount)
             )
-            await db.commit()
-            cursor = await db.execute("SELECT last_insert_rowid()")
-            purchase_id = (await cursor.fetchone())[0]
-            return purchase_id
+            purchase_id = cursor.lastrowid
+        return purchase_id
 
     async def get_purchase_by_id(self, purchase_id: str):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._read() as db:
             cursor = await db.execute(
                 """
                 SELECT id, user_id, product, amount, recipient_username, currency, price, invoice_id, status,
-                       created_at, updated_at, fragment_transaction_id, error_message, bonus_stars_used, bonus_discount
+                       created_at, updated_at, fragment_transaction_id, error_message, bonus_stars_used, bonus_discount, comment
                 FROM purchases WHERE id = ?
                 """,
                 (purchase_id,)
@@ -128,21 +627,110 @@ class Database:
                     "recipient_username": row[4], "currency": row[5], "price": row[6],
                     "invoice_id": row[7], "status": row[8], "created_at": row[9],
                     "updated_at": row[10], "fragment_transaction_id": row[11], "error_message": row[12],
-                    "bonus_stars_used": row[13], "bonus_discount": row[14]
+                    "bonus_stars_used": row[13], "bonus_discount": row[14], "comment": row[15]
                 }
             return None
 
+    async def get_user_purchases(self, user_id: int, before_id: int = None, limit: int = 20) -> list:
+        """Страница истории покупок пользователя от новых к старым, с id меньше before_id"""
+        async with self._read() as db:
+            cursor = await db.execute(
+                """
+                SELECT id, amount, recipient_username, currency, price, status, created_at
+                FROM purchases WHERE user_id = ? AND id < ?
+                ORDER BY id DESC LIMIT ?
+                """,
+                (user_id, before_id if before_id is not None else 2 ** 63 - 1, limit)
+            )
+            return [dict(row) for row in await cursor.fetchall()]
+
+    async def get_purchase_statuses(self, purchase_ids: list) -> list:
+        """Статусы нескольких покупок одним запросом (по 500 id - лимит параметров SQLite)"""
+        rows = []
+        async with self._read() as db:
+            for i in range(0, len(purchase_ids), 500):
+                chunk = purchase_ids[i:i + 500]
+                cursor = await db.execute(
+                    f"SELECT id, status, error_message FROM purchases WHERE id IN ({', '.join('?' * len(chunk))})",
+                    chunk
+                )
+                rows.extend(dict(row) for row in await cursor.fetchall())
+        return rows
+
+    async def get_open_invoices(self) -> dict:
+        """Ожидающие оплаты инвойсы CryptoPay: {invoice_id: purchase_id}"""
+        async with self._read() as db:
+            cursor = await db.execute(
+                "SELECT invoice_id, id FROM purchases WHERE status = 'pending' AND currency = 'USDT' AND invoice_id IS NOT NULL"
+            )
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+    async def get_pending_ton_comments(self) -> dict:
+        """Комментарии неоплаченных TON-покупок: {comment: purchase_id}"""
+        async with self._read() as db:
+            cursor = await db.execute(
+                "SELECT comment, id FROM purchases WHERE status = 'pending' AND currency = 'TON' AND comment IS NOT NULL"
+            )
+            return {row[0]: row[1] for row in await cursor.fetchall()}
+
+    async def get_poller_cursor(self, name: str) -> tuple:
+        """Последняя обработанная транзакция опросчика: (lt, hash), либо (0, "")"""
+        async with self._read() as db:
+            cursor = await db.execute("SELECT lt, hash FROM poller_cursors WHERE name = ?", (name,))
+            row = await cursor.fetchone()
+            return (row[0], row[1]) if row else (0, "")
+
+    async def save_poller_cursor(self, name: str, lt: int, tx_hash: str):
+        async with self._write() as db:
+            await db.execute(
+                "INSERT OR REPLACE INTO poller_cursors (name, lt, hash) VALUES (?, ?, ?)",
+                (name, lt, tx_hash)
+            )
+
+    async def expire_pending_purchases(self, created_before: str, error_message: str) -> list:
+        """Отмена одним запросом всех неоплаченных покупок, созданных раньше created_before"""
+        async with self._write() as db:
+            cursor = await db.execute(
+                """
+                SELECT id, user_id, amount, currency, invoice_id, comment FROM purchases
+                WHERE status = 'pending' AND created_at < ?
+                """,
+                (created_before,)
+            )
+            expired = [dict(row) for row in await cursor.fetchall()]
+            if expired:
+                now = timestamp()
+                await db.executemany(
+                    "UPDATE purchases SET status = 'cancelled', error_message = ?, updated_at = ? WHERE id = ? AND status = 'pending'",
+                    [(error_message, now, purchase["id"]) for purchase in expired]
+                )
+        for purchase in expired:
+            self._notify_status(purchase["id"], "cancelled", error_message)
+        return expired
+
     async def update_purchase_status(self, purchase_id: int, status: str, transaction_id: str = None, error_message: str = None):
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
+            cursor = await db.execute("SELECT status, amount, created_at FROM purchases WHERE id = ?", (purchase_id,))
+            previous = await cursor.fetchone()
             await db.execute(
                 "UPDATE purchases SET status = ?, fragment_transaction_id = ?, error_message = ?, updated_at = ? WHERE id = ?",
-                (status, transaction_id, error_message, (datetime.utcnow() + timedelta(hours=3)).strftime("%d.%m.%Y %H:%M:%S"), purchase_id)
+                (status, transaction_id, error_message, timestamp(), purchase_id)
             )
-            await db.commit()
+            # Поддерживаем суточные итоги при входе в статус completed и выходе из него
+            if previous and (previous["status"] == "completed") != (status == "completed"):
+                stars = previous["amount"] if status == "completed" else -previous["amount"]
+                await db.execute(
+                    """
+                    INSERT INTO stars_daily_stats (day, stars) VALUES (?, ?)
+                    ON CONFLICT(day) DO UPDATE SET stars = stars + excluded.stars
+                    """,
+                    (day_of(previous["created_at"]), stars)
+                )
+        self._notify_status(purchase_id, status, error_message)
 
     async def verify_auth_token(self, token: str):
         """Проверить токен авторизации"""
-        async with aiosqlite.connect(self.db_name) as db:
+        async with self._write() as db:
             cursor = await db.execute(
                 "SELECT user_id FROM auth_tokens WHERE token = ? AND expires_at > ?",
                 (token, datetime.utcnow())
@@ -152,64 +740,249 @@ class Database:
                 user_id = row[0]
                 # Удаляем токен после использования
                 await db.execute("DELETE FROM auth_tokens WHERE token = ?", (token,))
-                await db.commit()
                 return user_id
             return None
         
-    async def get_total_stars_sent(self) -> int:
-        """Получение общего количества отправленных звезд"""
+    async def get_stars_statistics(self) -> dict:
+        """Общее количество отправленных звезд, а также за сегодня и вчера (по суточным итогам)"""
         try:
-            async with aiosqlite.connect(self.db_name) as db:
+            today = msk_now()
+            async with self._read() as db:
                 cursor = await db.execute(
-                    "SELECT SUM(amount) FROM purchases WHERE status = 'completed'"
+                    """
+                    SELECT COALESCE(SUM(stars), 0),
+                           COALESCE(SUM(CASE WHEN day = ? THEN stars END), 0),
+                           COALESCE(SUM(CASE WHEN day = ? THEN stars END), 0)
+                    FROM stars_daily_stats
+                    """,
+                    (timestamp(today)[:10], timestamp(today - timedelta(days=1))[:10])
                 )
-                row = await cursor.fetchone()
-                return row[0] if row and row[0] else 0
+                total, today_stars, yesterday_stars = await cursor.fetchone()
+                return {"total": total, "today": today_stars, "yesterday": yesterday_stars}
         except Exception as e:
-            logging.error(f"Error getting total stars sent: {str(e)}")
-            return 0
+            logging.error(f"Error getting stars statistics: {str(e)}")
+            return {"total": 0, "today": 0, "yesterday": 0}
 
-    async def get_yesterday_stars_sent(self) -> int:
-        """Получение количества звезд, отправленных вчера"""
-        try:
-            yesterday_start = (datetime.utcnow() - timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
-            yesterday_end = yesterday_start + timedelta(days=1)
-            yesterday_start_str = yesterday_start.strftime("%d.%m.%Y %H:%M:%S")
-            yesterday_end_str = yesterday_end.strftime("%d.%m.%Y %H:%M:%S")
-            async with aiosqlite.connect(self.db_name) as db:
-                cursor = await db.execute(
-                    "SELECT SUM(amount) FROM purchases WHERE status = 'completed' AND created_at >= ? AND created_at < ?",
-                    (yesterday_start_str, yesterday_end_str)
-                )
-                row = await cursor.fetchone()
-                return row[0] if row and row[0] else 0
-        except Exception as e:
-            logging.error(f"Error getting yesterday stars sent: {str(e)}")
-            return 0
+    async def rebuild_daily_stats(self):
+        """Полный пересчет суточных итогов из таблицы purchases"""
+        async with self._write() as db:
+            for statement in REBUILD_DAILY_STATS:
+                await db.execute(statement)
 
-    async def get_today_stars_sent(self) -> int:
-        """Получение количества звезд, отправленных сегодня"""
-        try:
-            today_start = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0)
-            today_end = today_start + timedelta(days=1)
-            today_start_str = today_start.strftime("%d.%m.%Y %H:%M:%S")
-            today_end_str = today_end.strftime("%d.%m.%Y %H:%M:%S")
-            async with aiosqlite.connect(self.db_name) as db:
-                cursor = await db.execute(
-                    "SELECT SUM(amount) FROM purchases WHERE status = 'completed' AND created_at >= ? AND created_at < ?",
-                    (today_start_str, today_end_str)
+    async def log_transaction(self, purchase_id: int, event: str, level: str, message: str):
+        """
+        Запись в transaction_logs через буфер: строки пишутся пачкой раз в
+        TRANSACTION_LOG_FLUSH_INTERVAL секунд (или по TRANSACTION_LOG_BATCH_SIZE строк).
+        Внутри транзакции строка попадает в буфер только после ее фиксации.
+        """
+        row = (purchase_id, event, level, message, timestamp())
+        transaction = self._active_transaction()
+        if transaction:
+            transaction["logs"].append(row)
+        else:
+            self._buffer_logs([row])
+        logging.info(f"Transaction log: Purchase {purchase_id} - {event}: {message}")
+
+    def _buffer_logs(self, rows: list):
+        self._log_buffer.extend(rows)
+        if len(self._log_buffer) >= TRANSACTION_LOG_BATCH_SIZE:
+            self._log_flush_needed.set()
+
+    async def flush_transaction_logs(self) -> int:
+        """Запись накопленных строк журнала одним executemany; при ошибке строки возвращаются в буфер"""
+        async with self._log_flush_lock:
+            rows, self._log_buffer = self._log_buffer, []
+            if not rows:
+                return 0
+            try:
+                async with self._write() as db:
+                    await db.executemany(
+                        "INSERT INTO transaction_logs (purchase_id, action, status, details, timestamp) VALUES (?, ?, ?, ?, ?)",
+                        rows
+                    )
+            except BaseException:
+                self._log_buffer[:0] = rows
+                raise
+            return len(rows)
+
+    async def run_log_flusher(self):
+        """Фоновая задача каждого процесса: периодическая запись буфера transaction_logs"""
+        while True:
+            try:
+                await asyncio.wait_for(self._log_flush_needed.wait(), timeout=TRANSACTION_LOG_FLUSH_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+            self._log_flush_needed.clear()
+            try:
+                await self.flush_transaction_logs()
+            except Exception as e:
+                logging.error(f"Transaction log: flush of {len(self._log_buffer)} rows failed: {str(e)}")
+
+    async def enqueue_notification(self, chat_id: int, text: str, parse_mode: str = None) -> int:
+        async with self._write() as db:
+            cursor = await db.execute(
+                "INSERT INTO notifications (chat_id, text, parse_mode, next_attempt_at, created_at) VALUES (?, ?, ?, ?, ?)",
+                (chat_id, text, parse_mode, time.time(), timestamp())
+            )
+            return cursor.lastrowid
+
+    async def get_due_notifications(self, now: float, limit: int) -> list:
+        """Сообщения, которые пора отправить, в порядке постановки в очередь"""
+        async with self._read() as db:
+            cursor = await db.execute(
+                """
+                SELECT id, chat_id, text, parse_mode, attempts FROM notifications
+                WHERE next_attempt_at <= ? ORDER BY id LIMIT ?
+                """,
+                (now, limit)
+            )
+            return [dict(row) for row in await cursor.fetchall()]
+
+    async def delete_notifications(self, ids: list):
+        async with self._write() as db:
+            await db.executemany("DELETE FROM notifications WHERE id = ?", [(id_,) for id_ in ids])
+
+    async def defer_notifications(self, deferred: list):
+        """Перенос сообщений чатов на паузе без учета попытки: [(next_attempt_at, id), ...]"""
+        async with self._write() as db:
+            await db.executemany("UPDATE notifications SET next_attempt_at = ? WHERE id = ?", deferred)
+
+    async def reschedule_notifications(self, ids: list, next_attempt_at: float, error: str, count_attempt: bool = True):
+        """Перенос отправки сообщений на более позднее время"""
+        async with self._write() as db:
+            await db.executemany(
+                "UPDATE notifications SET attempts = attempts + ?, next_attempt_at = ?, last_error = ? WHERE id = ?",
+                [(int(count_attempt), next_attempt_at, error, id_) for id_ in ids]
+            )
+
+    async def enqueue_fulfillment_job(self, purchase_id: int):
+        """Постановка заказа в очередь доставки; повторная постановка игнорируется"""
+        async with self._write() as db:
+            await db.execute(
+                "INSERT OR IGNORE INTO fulfillment_jobs (purchase_id, run_at, created_at) VALUES (?, ?, ?)",
+                (purchase_id, time.time(), timestamp())
+            )
+
+    async def claim_fulfillment_job(self, now: float, lease: float):
+        """
+        Захват самого раннего готового задания на lease секунд.
+
+        Задание с незавершенной арендой невидимо для остальных обработчиков;
+        если обработчик не вернул его до конца аренды, задание снова доступно.
+        """
+        async with self._write() as db:
+            cursor = await db.execute(
+                """
+                UPDATE fulfillment_jobs SET locked_until = ?1 + ?2, attempts = attempts + 1
+                WHERE purchase_id = (
+                    SELECT purchase_id FROM fulfillment_jobs
+                    WHERE run_at <= ?1 AND (locked_until IS NULL OR locked_until <= ?1)
+                    ORDER BY run_at LIMIT 1
                 )
-                row = await cursor.fetchone()
-                return row[0] if row and row[0] else 0
-        except Exception as e:
-            logging.error(f"Error getting today stars sent: {str(e)}")
-            return 0
+                RETURNING purchase_id, stage, attempts, transaction_id
+                """,
+                (now, lease)
+            )
+            row = await cursor.fetchone()
+            return dict(row) if row else None
 
-    async def log_transaction(self, purchase_id: int, event: str, level: str, message: str):
-        async with aiosqlite.connect(self.db_name) as db:
+    async def has_other_fulfillment_jobs(self, purchase_id: int, recipient_username: str) -> bool:
+        """Есть ли в очереди другие заказы тому же получателю"""
+        async with self._read() as db:
+            cursor = await db.execute(
+                """
+                SELECT 1 FROM fulfillment_jobs j JOIN purchases p ON p.id = j.purchase_id
+                WHERE j.purchase_id != ? AND p.recipient_username = ? COLLATE NOCASE LIMIT 1
+                """,
+                (purchase_id, recipient_username)
+            )
+            return await cursor.fetchone() is not None
+
+    async def set_fulfillment_stage(self, purchase_id: int, stage: str, transaction_id: str = None):
+        async with self._write() as db:
+            await db.execute(
+                "UPDATE fulfillment_jobs SET stage = ?, transaction_id = COALESCE(?, transaction_id) WHERE purchase_id = ?",
+                (stage, transaction_id, purchase_id)
+            )
+
+    async def retry_fulfillment_job(self, purchase_id: int, run_at: float, error: str):
+        """Возврат задания в очередь после ошибки"""
+        async with self._write() as db:
             await db.execute(
-                "INSERT INTO transaction_logs (purchase_id, action, status, details, timestamp) VALUES (?, ?, ?, ?, ?)",
-                (purchase_id, event, level, message, (datetime.utcnow() + timedelta(hours=3)).strftime("%d.%m.%Y %H:%M:%S"))
+                "UPDATE fulfillment_jobs SET run_at = ?, locked_until = NULL, last_error = ? WHERE purchase_id = ?",
+                (run_at, error, purchase_id)
+            )
+
+    async def hold_fulfillment_job(self, purchase_id: int, run_at: float, error: str):
+        """Отложить задание на этапе ready без расхода попытки (Fragment отказал до отправки)"""
+        async with self._write() as db:
+            await db.execute(
+                """
+                UPDATE fulfillment_jobs SET stage = 'ready', run_at = ?, locked_until = NULL, last_error = ?,
+                       attempts = max(0, attempts - 1)
+                WHERE purchase_id = ?
+                """,
+                (run_at, error, purchase_id)
+            )
+
+    async def delete_fulfillment_job(self, purchase_id: int):
+        async with self._write() as db:
+            await db.execute("DELETE FROM fulfillment_jobs WHERE purchase_id = ?", (purchase_id,))
+
+    async def recover_fulfillment_jobs(self) -> int:
+        """
+        Восстановление очереди при запуске лидера: снятие аренд прежнего
+        процесса и постановка оплаченных заказов, у которых нет задания
+        (созданных до появления очереди). Если обработка такого заказа уже
+        начиналась, он ставится на этапе delivering - на ручную проверку.
+        """
+        await self.flush_transaction_logs()  # Этап определяется по журналу
+        async with self._write() as db:
+            await db.execute("UPDATE fulfillment_jobs SET locked_until = NULL WHERE locked_until IS NOT NULL")
+            cursor = await db.execute(
+                """
+                INSERT OR IGNORE INTO fulfillment_jobs (purchase_id, stage, run_at, created_at)
+                SELECT p.id,
+                       CASE WHEN EXISTS (
+                           SELECT 1 FROM transaction_logs l WHERE l.purchase_id = p.id AND l.action = 'processing_started'
+                       ) THEN 'delivering' ELSE 'queued' END,
+                       ?, ?
+                FROM purchases p WHERE p.status IN ('paid', 'processing')
+                """,
+                (time.time(), timestamp())
             )
-            await db.commit()
-            logging.info(f"Transaction log: Purchase {purchase_id} - {event}: {message}")
\ No newline at end of file
+            return cursor.rowcount
+
+    async def backfill_timestamps(self, batch_size: int = 500, pause: float = 0.05) -> dict:
+        """
+        Перевод старых временных меток ("%d.%m.%Y %H:%M:%S") в ISO-8601.
+
+        Строки обрабатываются окнами по id, каждое окно - отдельная короткая
+        транзакция, поэтому таблица не блокируется надолго. Повторный запуск безопасен.
+        """
+        targets = {
+            "purchases": ("id", ("created_at", "updated_at")),
+            "transaction_logs": ("id", ("timestamp",)),
+        }
+        converted = {}
+        for table, (key, columns) in targets.items():
+            async with self._read() as db:
+                cursor = await db.execute(f"SELECT MIN({key}), MAX({key}) FROM {table}")
+                low, high = await cursor.fetchone()
+            converted[table] = 0
+            if low is None:
+                continue
+            assignments = ", ".join(f"{column} = {_legacy_to_iso(column)}" for column in columns)
+            legacy = " OR ".join(f"{column} LIKE '{LEGACY_TIMESTAMP_LIKE}'" for column in columns)
+            for start in range(low, high + 1, batch_size):
+                async with self._write() as db:
+                    cursor = await db.execute(
+                        f"UPDATE {table} SET {assignments} WHERE {key} >= ? AND {key} < ? AND ({legacy})",
+                        (start, start + batch_size)
+                    )
+                    converted[table] += cursor.rowcount
+                await asyncio.sleep(pause)  # Даем пройти другим записям
+            logging.info(f"Timestamps backfill: {table} - {converted[table]} rows converted")
+        return converted
+
+instrument_methods(Database, "db_method_duration_seconds", exclude=("run_log_flusher",))  # Время каждого метода в /metrics
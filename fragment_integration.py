@@ -1,14 +1,28 @@
 import asyncio
 import logging
+import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from typing import Optional, Dict, Any
 from dataclasses import dataclass
 from fragment_api_lib.client import FragmentAPIClient
+from fragment_api_lib.exceptions import FragmentAPIError
 from dotenv import load_dotenv
+from config import (
+    FRAGMENT_MAX_WORKERS, FRAGMENT_BUY_TIMEOUT, FRAGMENT_BALANCE_TIMEOUT,
+    FRAGMENT_BALANCE_TTL, FRAGMENT_LOW_BALANCE_TON, FRAGMENT_STAR_PRICE_TON, FRAGMENT_COALESCE_WINDOW,
+    FRAGMENT_LOOKUP_TIMEOUT, FRAGMENT_LOOKUP_WORKERS, RECIPIENT_CACHE_TTL, RECIPIENT_NEGATIVE_TTL, RECIPIENT_CACHE_SIZE
+)
+from helpers.metrics import outbound
 import os
 
 # Загрузка переменных окружения
 load_dotenv()
 
+USERNAME_RE = re.compile(r"[A-Za-z][A-Za-z0-9_]{3,31}")  # Формат username Telegram (4-32 символа)
+
 @dataclass
 class FragmentResult:
     """Результат операции с Fragment"""
@@ -16,6 +30,7 @@ class FragmentResult:
     transaction_id: Optional[str] = None
     message: str = ""
     error: Optional[str] = None
+    unknown_outcome: bool = False  # Ответ не получен: звезды могли быть отправлены
 
 class FragmentIntegration:
     """
@@ -24,17 +39,107 @@ class FragmentIntegration:
     Требует:
     - Установка библиотеки: pip install fragment-api-lib==1.0.1
     - Настройка переменных окружения: FRAGMENT_SEED, FRAGMENT_COOKIES
+    
+    Клиент синхронный, поэтому его методы выполняются в отдельном пуле
+    из FRAGMENT_MAX_WORKERS потоков, не блокируя event loop. Проверки
+    получателей идут через свой пул из FRAGMENT_LOOKUP_WORKERS потоков и не
+    занимают потоки покупок.
     """
     
-    def __init__(self):
+    def __init__(self, max_workers: int = FRAGMENT_MAX_WORKERS):
         self.seed = os.getenv("FRAGMENT_SEED")
         self.cookies = os.getenv("FRAGMENT_COOKIES")
         self.is_configured = bool(self.seed)
         self.client = FragmentAPIClient()
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="fragment")
+        self._pending = 0  # Вызовы, отправленные в пул и еще не завершенные
+        self._lookup_executor = ThreadPoolExecutor(max_workers=FRAGMENT_LOOKUP_WORKERS, thread_name_prefix="fragment-lookup")
+        self._lookups = 0  # Проверки получателей в потоках, включая прерванные таймаутом
+        self._lookup_freed = asyncio.Event()  # Освободился поток проверок
         
         if not self.is_configured:
             print("WARNING: Fragment API не настроен. Проверьте FRAGMENT_SEED в .env")
     
+    @property
+    def in_flight(self) -> int:
+        """Количество выполняющихся вызовов Fragment API"""
+        return min(self._pending, self.max_workers)
+    
+    @property
+    def queued(self) -> int:
+        """Количество вызовов, ожидающих свободного потока"""
+        return max(0, self._pending - self.max_workers)
+    
+    async def _run(self, func, timeout: float, **kwargs):
+        """
+        Выполнение синхронного метода клиента в пуле потоков
+        
+        Таймаут отсчитывается с момента, когда вызов взял поток: время в
+        очереди пула не сокращает время на сам запрос. По таймауту ожидание
+        прерывается, но поток завершит вызов сам: остановить запрос к API
+        из другого потока нельзя.
+        """
+        loop = asyncio.get_running_loop()
+        started = asyncio.Event()
+        
+        def call():
+            loop.call_soon_threadsafe(started.set)
+            return func(**kwargs)
+        
+        self._pending += 1
+        if self.queued:
+            logging.warning(f"Fragment API: {self.queued} вызовов в очереди, {self.in_flight} выполняется")
+        future = loop.run_in_executor(self._executor, call)
+        future.add_done_callback(self._on_done)
+        with outbound("fragment", func.__name__):
+            await started.wait()
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+    
+    async def _run_lookup(self, func, timeout: float, **kwargs):
+        """Выполнение проверки получателя в пуле проверок (вызывающий проверяет lookup_busy или ждет потока)"""
+        loop = asyncio.get_running_loop()
+        self._lookups += 1
+        future = loop.run_in_executor(self._lookup_executor, partial(func, **kwargs))
+        future.add_done_callback(self._on_lookup_done)
+        with outbound("fragment", func.__name__):
+            return await asyncio.wait_for(asyncio.shield(future), timeout)
+    
+    @property
+    def lookup_busy(self) -> bool:
+        """Все потоки проверок заняты: новую проверку не ставим в очередь"""
+        return self._lookups >= FRAGMENT_LOOKUP_WORKERS
+    
+    async def _wait_lookup_slot(self, timeout: float) -> bool:
+        """Ожидание свободного потока проверок не дольше timeout"""
+        deadline = asyncio.get_running_loop().time() + timeout
+        while self.lookup_busy:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                return False
+            self._lookup_freed.clear()
+            try:
+                await asyncio.wait_for(self._lookup_freed.wait(), remaining)
+            except asyncio.TimeoutError:
+                return False
+        return True
+    
+    def _on_lookup_done(self, future):
+        self._lookups -= 1
+        self._lookup_freed.set()
+        if not future.cancelled():
+            future.exception()
+    
+    def _on_done(self, future):
+        self._pending -= 1
+        if not future.cancelled():
+            future.exception()  # Ошибка после таймаута уже никем не ожидается
+    
+    def close(self):
+        """Остановка пула потоков без ожидания незавершенных вызовов"""
+        self._executor.shutdown(wait=False)
+        self._lookup_executor.shutdown(wait=False)
+    
     async def buy_stars(self, amount: int, recipient_username: str) -> FragmentResult:
         """
         Покупка звезд через Fragment API
@@ -57,7 +162,9 @@ class FragmentIntegration:
             )
         
         try:
-            result = self.client.buy_stars_without_kyc(
+            result = await self._run(
+                self.client.buy_stars_without_kyc,
+                FRAGMENT_BUY_TIMEOUT,
                 username=recipient_username,
                 amount=amount,
                 seed=self.seed
@@ -81,6 +188,14 @@ class FragmentIntegration:
                 message=f"Успешно отправлено {amount} звезд пользователю @{recipient_username}"
             )
             
+        except asyncio.TimeoutError:
+            print("ERROR: Таймаут покупки звезд, статус транзакции неизвестен")
+            return FragmentResult(
+                success=False,
+                error=f"Fragment API не ответил за {FRAGMENT_BUY_TIMEOUT} с, статус транзакции неизвестен",
+                message=f"Не удалось купить {amount} звезд для @{recipient_username}",
+                unknown_outcome=True
+            )
         except ValueError as e:
             print("ERROR: Ошибка значения при покупке звезд:", str(e))
             return FragmentResult(
@@ -129,46 +244,188 @@ class FragmentIntegration:
             print("ERROR: Ошибка при проверке статуса транзакции", transaction_id, ":", str(e))
             return "failed"
     
-    async def get_balance(self) -> float:
+    async def get_user_info(self, username: str, wait: bool = False) -> Optional[Dict[str, Any]]:
+        """
+        Проверка получателя звезд в Fragment
+        
+        Args:
+            username: Username получателя без @
+            wait: Ждать свободного потока проверок вместо пропуска проверки;
+                ожидание и сама проверка укладываются в FRAGMENT_LOOKUP_TIMEOUT
+            
+        Returns:
+            Dict: {"found": bool, "name": str}, либо None, если проверить не удалось
+        """
+        if not self.cookies:
+            return None
+        started = time.monotonic()
+        if self.lookup_busy and not (wait and await self._wait_lookup_slot(FRAGMENT_LOOKUP_TIMEOUT)):
+            print("WARNING: Пул проверок получателей занят, проверка", username, "пропущена")
+            return None
+        
+        try:
+            result = await self._run_lookup(
+                self.client.get_user_info,
+                max(0, FRAGMENT_LOOKUP_TIMEOUT - (time.monotonic() - started)),
+                username=username,
+                fragment_cookies=self.cookies
+            )
+        except FragmentAPIError as e:
+            # "404 | ..." / "400 | ..." - Fragment не знает получателя, прочие коды - сбой проверки
+            if str(e).split(" | ", 1)[0] in ("400", "404"):
+                return {"found": False}
+            print("ERROR: Ошибка API при проверке получателя", username, ":", str(e))
+            return None
+        except asyncio.TimeoutError:
+            print("ERROR: Таймаут при проверке получателя", username)
+            return None
+        except Exception as e:
+            print("ERROR: Неизвестная ошибка при проверке получателя", username, ":", str(e))
+            return None
+        
+        if result.get("error") or not result.get("success", True):
+            return {"found": False}
+        return {"found": True, "name": result.get("name")}
+    
+    async def get_balance(self) -> Optional[float]:
         """
         Получение баланса аккаунта
         
         Returns:
-            float: Баланс в TON
+            float: Баланс в TON, либо None, если получить его не удалось
         """
         print("INFO: Получение баланса аккаунта")
         
         if not self.is_configured:
-            print("ERROR: Fragment API не настроен. Возвращается нулевой баланс.")
-            return 0.0
+            print("ERROR: Fragment API не настроен. Баланс неизвестен.")
+            return None
         
         try:
-            result = self.client.get_balance(seed=self.seed)
+            result = await self._run(self.client.get_balance, FRAGMENT_BALANCE_TIMEOUT, seed=self.seed)
             
             # Проверяем, содержит ли результат ошибку
             if result.get("error") or not result.get("success", True):
                 error_message = result.get("error", "Неизвестная ошибка API")
                 print("ERROR: Ошибка API при получении баланса:", error_message)
-                return 0.0
+                return None
                 
             balance = float(result.get("balance", 0.0))
             return balance
             
+        except asyncio.TimeoutError:
+            print("ERROR: Таймаут при получении баланса")
+            return None
         except ValueError as e:
             print("ERROR: Ошибка значения при получении баланса:", str(e))
-            return 0.0
+            return None
         except RuntimeError as e:
             print("ERROR: Ошибка выполнения при получении баланса:", str(e))
-            return 0.0
+            return None
         except Exception as e:
             print("ERROR: Неизвестная ошибка при получении баланса:", str(e))
-            return 0.0
+            return None
 
 class FragmentService:
-    """Сервис для работы с Fragment"""
+    """
+    Сервис для работы с Fragment
+    
+    Баланс кошелька кэшируется: обновляется в фоне раз в FRAGMENT_BALANCE_TTL
+    секунд и уменьшается локально на оценочную стоимость каждой доставки.
+    При сбое обновления остается последний известный баланс; пока баланс
+    неизвестен, доставки им не ограничиваются.
+    """
     
     def __init__(self):
         self.integration = FragmentIntegration()
+        self.balance: Optional[float] = None  # Прогнозируемый баланс в TON
+        self._balance_updated_at = None  # Время последней попытки обновления (loop.time())
+        self._balance_lock = asyncio.Lock()
+        self._batches = {}  # {получатель: {"recipient", "amounts", "future", "task"}} - открытые окна объединения
+        self._recipients = OrderedDict()  # LRU: {username: (результат проверки, срок действия)}
+        self._recipient_lookups = {}  # {username: asyncio.Task} - выполняющиеся проверки
+    
+    def close(self):
+        self.integration.close()
+    
+    async def refresh_balance(self) -> Optional[float]:
+        """Запрос актуального баланса у Fragment; при сбое остается последний известный"""
+        async with self._balance_lock:
+            balance = await self.integration.get_balance()
+            if balance is not None:
+                self.balance = balance
+            # Время обновляется и при сбое: следующий запрос - не раньше чем через FRAGMENT_BALANCE_TTL
+            self._balance_updated_at = asyncio.get_running_loop().time()
+        if self.balance is not None and self.balance < FRAGMENT_LOW_BALANCE_TON:
+            logging.warning(f"Fragment: баланс кошелька {self.balance:.4f} TON ниже порога {FRAGMENT_LOW_BALANCE_TON} TON")
+        return self.balance
+    
+    async def get_balance(self) -> Optional[float]:
+        """Баланс из кэша, запрос к Fragment только если кэш устарел; None - баланс неизвестен"""
+        if self._balance_updated_at is None or asyncio.get_running_loop().time() - self._balance_updated_at >= FRAGMENT_BALANCE_TTL:
+            return await self.refresh_balance()
+        return self.balance
+    
+    async def run_balance_refresher(self):
+        """Фоновая задача обновления кэша баланса"""
+        while True:
+            try:
+                await self.refresh_balance()
+            except Exception as e:
+                logging.error(f"Fragment: ошибка при обновлении баланса: {e}")
+            await asyncio.sleep(FRAGMENT_BALANCE_TTL)
+    
+    async def check_recipient(self, username: str, wait: bool = False) -> Dict[str, Any]:
+        """
+        Проверка получателя до оплаты
+        
+        Результаты кэшируются: найденные на RECIPIENT_CACHE_TTL, ненайденные на
+        RECIPIENT_NEGATIVE_TTL. Одновременные проверки одного username
+        выполняются одним запросом к Fragment. Когда все потоки проверок заняты,
+        новая проверка пропускается, а с wait=True (создание покупки) ждет
+        свободного потока не дольше FRAGMENT_LOOKUP_TIMEOUT.
+        
+        Returns:
+            Dict: {"username", "valid", "name", "error"}; valid = None, если Fragment
+            недоступен - такую покупку не блокируем
+        """
+        username = (username or "").strip().lstrip("@")
+        if not USERNAME_RE.fullmatch(username):
+            return {"username": username, "valid": False, "name": None, "error": "Неверный формат username"}
+        
+        key = username.lower()
+        cached = self._recipients.get(key)
+        if cached:
+            if time.monotonic() < cached[1]:
+                self._recipients.move_to_end(key)
+                return dict(cached[0])
+            del self._recipients[key]
+        
+        task = self._recipient_lookups.get(key)
+        if task is None:
+            if self.integration.lookup_busy and not wait:
+                print("WARNING: Пул проверок получателей занят, проверка", username, "пропущена")
+                return {"username": username, "valid": None, "name": None, "error": None}
+            task = asyncio.create_task(self._lookup_recipient(username, key))
+            self._recipient_lookups[key] = task
+            task.add_done_callback(lambda _: self._recipient_lookups.pop(key, None))
+        return dict(await asyncio.shield(task))
+    
+    async def _lookup_recipient(self, username: str, key: str) -> Dict[str, Any]:
+        # Запущенную проверку могут ждать и покупки, поэтому она не пропускается
+        info = await self.integration.get_user_info(username, wait=True)
+        if info is None:
+            return {"username": username, "valid": None, "name": None, "error": None}
+        result = {
+            "username": username,
+            "valid": info["found"],
+            "name": info.get("name"),
+            "error": None if info["found"] else "Пользователь не найден"
+        }
+        ttl = RECIPIENT_CACHE_TTL if info["found"] else RECIPIENT_NEGATIVE_TTL
+        self._recipients[key] = (result, time.monotonic() + ttl)
+        if len(self._recipients) > RECIPIENT_CACHE_SIZE:
+            self._recipients.popitem(last=False)
+        return result
     
     async def process_stars_purchase(self, amount: int, recipient_username: str) -> Dict[str, Any]:
         """
@@ -181,10 +438,22 @@ class FragmentService:
         Returns:
             Dict: Результат обработки
         """
+        cost = amount * FRAGMENT_STAR_PRICE_TON
+        reserved = False
         try:
-            # Проверяем баланс
-            balance = await self.integration.get_balance()
-            print("INFO: Баланс аккаунта:", balance, "TON")
+            # Проверяем прогнозируемый баланс без запроса к Fragment; неизвестный баланс не блокирует доставку
+            balance = await self.get_balance()
+            if balance is not None:
+                if balance < cost:
+                    # Звезды не отправлялись: заказ можно повторить после пополнения
+                    return {
+                        "success": False,
+                        "retry": True,
+                        "error": f"Недостаточно средств на кошельке Fragment: {balance:.4f} TON, требуется {cost:.4f} TON",
+                        "message": "Произошла ошибка при обработке заказа"
+                    }
+                self.balance -= cost  # Резервируем до завершения покупки
+                reserved = True
             
             # Покупаем звезды
             #result = await self.integration.buy_stars(amount, recipient_username)
@@ -193,18 +462,78 @@ class FragmentService:
                 transaction_id='test_id',
                 message=f"Успешно test {amount} звезд пользователю @{recipient_username}"
             )
+            if reserved and not result.success:
+                self.balance += cost
             
             return {
                 "success": result.success,
                 "transaction_id": result.transaction_id,
                 "message": result.message,
-                "error": result.error
+                "error": result.error,
+                "unknown_outcome": result.unknown_outcome
             }
             
         except Exception as e:
             print("ERROR: Ошибка при обработке покупки звезд:", str(e))
+            if reserved:
+                self.balance += cost
             return {
                 "success": False,
                 "error": str(e),
                 "message": "Произошла ошибка при обработке заказа"
-            }
\ No newline at end of file
+            }
+    
+    async def submit_stars_purchase(self, amount: int, recipient_username: str, expect_more: bool = False) -> Dict[str, Any]:
+        """
+        Покупка звезд с объединением заказов одному получателю
+        
+        Если получателю ждут доставки и другие заказы (expect_more), открывается
+        окно FRAGMENT_COALESCE_WINDOW секунд; заказы, пришедшие в него, покупаются
+        одной транзакцией Fragment, ее результат получает каждый заказ. Одиночный
+        заказ покупается сразу. При ошибке объединенной покупки заказы покупаются по
+        отдельности, кроме случая неизвестного исхода (таймаут): повтор мог бы
+        отправить звезды дважды.
+        
+        Returns:
+            Dict: Результат обработки этого заказа, batch_size - размер объединения
+        """
+        key = recipient_username.lstrip("@").lower()
+        batch = self._batches.get(key)
+        if batch is None and (FRAGMENT_COALESCE_WINDOW <= 0 or not expect_more):
+            return {**await self.process_stars_purchase(amount, recipient_username), "batch_size": 1}
+        if batch is None:
+            batch = {
+                "recipient": recipient_username,
+                "amounts": [],
+                "future": asyncio.get_running_loop().create_future()
+            }
+            self._batches[key] = batch
+            batch["task"] = asyncio.create_task(self._flush_batch(key, batch))
+        index = len(batch["amounts"])
+        batch["amounts"].append(amount)
+        # shield: отмена одного ожидающего не отменяет покупку для остальных
+        results = await asyncio.shield(batch["future"])
+        return results[index]
+    
+    async def _flush_batch(self, key: str, batch: dict):
+        """Покупка по окончании окна объединения и раздача результатов"""
+        try:
+            await asyncio.sleep(FRAGMENT_COALESCE_WINDOW)
+            del self._batches[key]  # Новые заказы открывают следующее окно
+            amounts = batch["amounts"]
+            recipient = batch["recipient"]
+            if len(amounts) == 1:
+                results = [{**await self.process_stars_purchase(amounts[0], recipient), "batch_size": 1}]
+            else:
+                combined = await self.process_stars_purchase(sum(amounts), recipient)
+                if combined["success"] or combined.get("unknown_outcome"):
+                    results = [{**combined, "batch_size": len(amounts)} for _ in amounts]
+                else:
+                    logging.warning(f"Fragment: объединенная покупка {len(amounts)} заказов для @{recipient} не удалась ({combined['error']}), покупаем по отдельности")
+                    singles = await asyncio.gather(*(self.process_stars_purchase(amount, recipient) for amount in amounts))
+                    results = [{**result, "batch_size": 1} for result in singles]
+            batch["future"].set_result(results)
+        except Exception as e:
+            if self._batches.get(key) is batch:
+                del self._batches[key]
+            batch["future"].set_exception(e)
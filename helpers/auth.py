@@ -1,28 +1,131 @@
 import hmac
 import hashlib
-import urllib.parse
 import json
+import logging
 import os
+import time
+from collections import OrderedDict
+from functools import wraps
+from urllib.parse import unquote
 from dotenv import load_dotenv
+from quart import g, jsonify, request
+from config import INIT_DATA_TTL, INIT_DATA_CACHE_SIZE
 
 load_dotenv()
 
-def validate_init_data(init_data: str) -> int:
-    """Проверка Telegram initData для аутентификации."""
+logger = logging.getLogger(__name__)
+
+def _derive_secret_key(bot_token: str):
+    """Ключ проверки initData: HMAC-SHA256 токена бота с ключом "WebAppData" """
+    if not bot_token:
+        return None
+    return hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
+
+_secret_key = _derive_secret_key(os.getenv("BOT_TOKEN"))  # Вычисляется один раз при запуске
+_verified = OrderedDict()  # LRU: {initData: (результат проверки, срок действия)}
+
+def verify_init_data(init_data_raw: str) -> dict:
+    """
+    Проверка подлинности initData от Telegram Web App с URL-декодированием.
+
+    Успешные проверки кэшируются до истечения INIT_DATA_TTL с момента auth_date,
+    поэтому повторные запросы в рамках сессии не пересчитывают HMAC.
+    """
+    cached = _verified.get(init_data_raw)
+    if cached:
+        result, expires_at = cached
+        if time.time() < expires_at:
+            _verified.move_to_end(init_data_raw)
+            return result
+        del _verified[init_data_raw]
+
     try:
-        bot_token = os.getenv("BOT_TOKEN")
-        secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
-        parsed_data = urllib.parse.parse_qs(init_data)
-        received_hash = parsed_data.get("hash", [""])[0]
-        data_check_string = "\n".join(
-            f"{k}={v[0]}" for k, v in sorted(parsed_data.items()) if k != "hash"
-        )
-        computed_hash = hmac.new(
-            secret_key, data_check_string.encode(), hashlib.sha256
-        ).hexdigest()
-        if computed_hash != received_hash:
-            raise ValueError("Неверный hash initData")
-        user_data = json.loads(parsed_data["user"][0])
-        return user_data["id"]
+        if not _secret_key:
+            return {"error": "BOT_TOKEN не настроен"}
+
+        # URL-декодирование initData
+        try:
+            init_data_decoded = unquote(init_data_raw)
+        except Exception as e:
+            return {"error": f"Неверный формат initData: {str(e)}"}
+
+        # Парсинг параметров
+        params = {}
+        for pair in init_data_decoded.split("&"):
+            if "=" in pair:
+                key, value = pair.split("=", 1)
+                params[key] = value
+
+        # Извлечение хеша
+        received_hash = params.pop("hash", None)
+        if not received_hash:
+            return {"error": "Отсутствует hash в данных"}
+
+        # Создание строки для проверки и вычисление хеша
+        data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()))
+        computed_hash = hmac.new(_secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
+        if not hmac.compare_digest(computed_hash, received_hash):
+            return {"error": "Неверный hash в данных"}
+
+        # Проверка срока действия
+        try:
+            expires_at = int(params.get("auth_date", 0)) + INIT_DATA_TTL
+        except ValueError:
+            return {"error": "Неверный формат auth_date"}
+        if time.time() >= expires_at:
+            return {"error": "Срок действия initData истек"}
+
+        # Извлечение данных пользователя
+        user_str = params.get("user")
+        if not user_str:
+            return {"error": "Отсутствует параметр user"}
+
+        try:
+            user = json.loads(user_str)
+        except json.JSONDecodeError:
+            return {"error": "Неверный формат данных пользователя"}
+        result = {
+            "user_id": user.get("id"),
+            "username": user.get("username", "").lstrip("@"),
+            "first_name": user.get("first_name"),
+            "last_name": user.get("last_name")
+        }
+        _verified[init_data_raw] = (result, expires_at)
+        if len(_verified) > INIT_DATA_CACHE_SIZE:
+            _verified.popitem(last=False)
+        return result
     except Exception as e:
-        raise ValueError(f"Ошибка проверки initData: {str(e)}")
\ No newline at end of file
+        return {"error": f"Ошибка проверки initData: {str(e)}"}
+
+def validate_init_data(init_data: str) -> int:
+    """Проверка Telegram initData для аутентификации, возвращает ID пользователя."""
+    result = verify_init_data(init_data)
+    if "error" in result:
+        raise ValueError(f"Ошибка проверки initData: {result['error']}")
+    return result["user_id"]
+
+def require_tg_user(view=None, *, optional: bool = False):
+    """
+    Декоратор маршрута: проверяет initData (поле initData в JSON или заголовок
+    X-Telegram-Init-Data) и кладет пользователя в g.tg_user.
+
+    С optional=True запрос без initData пропускается с g.tg_user = None.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            data = await request.get_json(silent=True) or {}
+            init_data = data.get("initData") or request.headers.get("X-Telegram-Init-Data")
+            g.tg_user = None
+            if not init_data:
+                if optional:
+                    return await func(*args, **kwargs)
+                return jsonify({"error": "No initData provided"}), 400
+            result = verify_init_data(init_data)
+            if "error" in result:
+                logger.error(f"Verify initData failed: {result['error']}")
+                return jsonify({"error": result["error"]}), 400
+            g.tg_user = result
+            return await func(*args, **kwargs)
+        return wrapper
+    return decorator(view) if view else decorator
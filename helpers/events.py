@@ -0,0 +1,53 @@
+import asyncio
+import logging
+from config import EVENTS_RESYNC_INTERVAL
+from helpers.metrics import gauge
+
+TERMINAL_STATUSES = ("completed", "failed", "cancelled")
+
+_subscribers = {}  # {purchase_id: set(asyncio.Queue)} - подписчики на изменения статуса
+_polled_statuses = {}  # {purchase_id: status} - последний статус подписанных покупок, прочитанный из БД
+
+gauge("purchase_event_streams", "Открытые SSE-потоки статуса покупок", lambda: sum(len(queues) for queues in _subscribers.values()))
+
+def subscribe(purchase_id: int) -> asyncio.Queue:
+    """Подписка на изменения статуса покупки"""
+    queue = asyncio.Queue()
+    _subscribers.setdefault(int(purchase_id), set()).add(queue)
+    return queue
+
+def unsubscribe(purchase_id: int, queue: asyncio.Queue):
+    queues = _subscribers.get(int(purchase_id))
+    if queues is None:
+        return
+    queues.discard(queue)
+    if not queues:
+        del _subscribers[int(purchase_id)]
+
+def publish_status(purchase_id: int, status: str, error_message: str = None):
+    """Рассылка нового статуса покупки подписчикам этого процесса"""
+    for queue in _subscribers.get(int(purchase_id), ()):
+        queue.put_nowait({"purchase_id": int(purchase_id), "status": status, "error_message": error_message})
+
+async def run_status_poller(db):
+    """
+    Фоновая задача воркера при WEB_WORKERS > 1: статусы меняет лидер, в этот процесс
+    они приходят только через БД. Один запрос на все подписанные покупки раз в
+    EVENTS_RESYNC_INTERVAL; изменения рассылаются как обычные события.
+    """
+    while True:
+        await asyncio.sleep(EVENTS_RESYNC_INTERVAL)
+        for purchase_id in [pid for pid in _polled_statuses if pid not in _subscribers]:
+            del _polled_statuses[purchase_id]
+        if not _subscribers:
+            continue
+        try:
+            rows = await db.get_purchase_statuses(list(_subscribers))
+        except Exception as e:
+            logging.error(f"Events: ошибка чтения статусов покупок: {e}")
+            continue
+        for row in rows:
+            # Новый подписчик сравнивает событие с уже отправленным статусом сам
+            if _polled_statuses.get(row["id"]) != row["status"]:
+                _polled_statuses[row["id"]] = row["status"]
+                publish_status(row["id"], row["status"], row["error_message"])
@@ -0,0 +1,200 @@
+import asyncio
+import logging
+import time
+from quart import current_app
+from config import ADMIN_ID, FRAGMENT_BALANCE_TTL, FULFILLMENT_WORKERS, FULFILLMENT_LEASE, FULFILLMENT_MAX_ATTEMPTS, FULFILLMENT_RETRY_DELAY, FULFILLMENT_POLL_INTERVAL
+from helpers.events import TERMINAL_STATUSES
+from helpers.metrics import gauge
+from helpers.notifications import notify
+from helpers.referrals import credit_referrer
+
+logging.basicConfig(filename="logs/site.log", level=logging.INFO)
+
+_wakeup = asyncio.Event()  # Будит обработчиков очереди при постановке задания в этом процессе
+_running = 0  # Задания, выполняющиеся прямо сейчас
+
+gauge("fulfillment_jobs_running", "Выполняющиеся задания доставки", lambda: _running)
+
+async def enqueue_fulfillment(db, purchase_id: int):
+    """
+    Постановка оплаченного заказа в очередь доставки.
+
+    Вызывается в той же транзакции, что и подтверждение оплаты: задание
+    фиксируется вместе со статусом и переживает перезапуск.
+    """
+    await db.enqueue_fulfillment_job(purchase_id)
+    _wakeup.set()
+
+async def run_fulfillment_workers():
+    """Фоновая задача лидера: восстановление очереди и FULFILLMENT_WORKERS обработчиков"""
+    db = current_app.config["DB"]
+    recovered = await db.recover_fulfillment_jobs()
+    if recovered:
+        logging.warning(f"Fulfillment: {recovered} оплаченных заказов без задания поставлены в очередь")
+    await asyncio.gather(*(_fulfillment_worker(db) for _ in range(FULFILLMENT_WORKERS)))
+
+async def _fulfillment_worker(db):
+    global _running
+    while True:
+        try:
+            _wakeup.clear()
+            job = await db.claim_fulfillment_job(time.time(), FULFILLMENT_LEASE)
+            if job is None:
+                # Задания из других воркеров HTTP приходят без уведомления - опрашиваем
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=FULFILLMENT_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _running += 1
+            try:
+                await run_fulfillment_job(db, job)
+            finally:
+                _running -= 1
+        except Exception as e:
+            logging.error(f"Fulfillment: ошибка обработчика очереди: {e}")
+            await asyncio.sleep(FULFILLMENT_POLL_INTERVAL)
+
+async def run_fulfillment_job(db, job: dict):
+    """Выполнение задания; при ошибке - повтор с экспоненциальной задержкой"""
+    purchase_id = job["purchase_id"]
+    try:
+        await process_stars_purchase(purchase_id, job["stage"], job["transaction_id"])
+    except Exception as e:
+        if job["attempts"] < FULFILLMENT_MAX_ATTEMPTS:
+            delay = FULFILLMENT_RETRY_DELAY * 2 ** (job["attempts"] - 1)
+            logging.error(f"Purchase {purchase_id}: attempt {job['attempts']} failed, retry in {delay}s - {str(e)}")
+            await db.retry_fulfillment_job(purchase_id, time.time() + delay, str(e))
+            return
+        async with db.transaction():
+            await db.update_purchase_status(purchase_id, "failed", error_message=str(e))
+            await db.log_transaction(purchase_id, "processing_failed", "error", f"Ошибка: {str(e)}")
+            await db.delete_fulfillment_job(purchase_id)
+            # Отправляем уведомление об ошибке
+            purchase = await db.get_purchase_by_id(str(purchase_id))
+            if purchase and purchase["user_id"]:
+                await notify(purchase["user_id"], f"Покупка #{purchase_id} на {purchase['amount']} звезд не удалась: {str(e)}")
+        logging.error(f"Purchase {purchase_id}: Failed after {job['attempts']} attempts - {str(e)}")
+
+async def process_stars_purchase(purchase_id: int, stage: str = "queued", transaction_id: str = None):
+    """
+    Обработка покупки звезд после подтверждения оплаты.
+
+    Каждый переход состояния вместе с побочными эффектами (журнал, бонусы,
+    реферальные начисления, уведомления) фиксируется одной транзакцией.
+    Вызов Fragment выполняется вне транзакции. Этап задания сохраняется
+    перед вызовом Fragment и после него, поэтому повтор не списывает бонусы
+    и не отправляет звезды дважды. Исключение возвращает задание в очередь.
+    Этап ready - бонусы списаны, а Fragment отказал до отправки (нет средств):
+    такое задание повторяется раз в FRAGMENT_BALANCE_TTL без расхода попыток.
+    """
+    db = current_app.config["DB"]
+    fragment_service = current_app.config["FRAGMENT"]
+
+    async with db.transaction():
+        purchase = await db.get_purchase_by_id(str(purchase_id))
+        if not purchase or purchase["status"] in TERMINAL_STATUSES:
+            await db.delete_fulfillment_job(purchase_id)
+            if not purchase:
+                logging.error(f"Purchase {purchase_id}: Not found")
+            return
+
+        if stage == "delivering":
+            # Прошлая попытка прервалась во время вызова Fragment: результат неизвестен
+            error = "Доставка прервана, требуется ручная проверка"
+            await db.update_purchase_status(purchase_id, "failed", error_message=error)
+            await db.log_transaction(purchase_id, "delivery_interrupted", "error", error)
+            await db.delete_fulfillment_job(purchase_id)
+            await notify(
+                ADMIN_ID[0],
+                f"<b>⚠️ Проверьте заказ #{purchase_id}</b>\n\n"
+                f"Доставка {purchase['amount']} звёзд для @{purchase['recipient_username']} прервалась, "
+                f"звёзды могли быть отправлены.",
+                parse_mode="HTML"
+            )
+            logging.error(f"Purchase {purchase_id}: Delivery interrupted, manual check required")
+            return
+
+        if stage == "queued":
+            await db.log_transaction(purchase_id, "processing_started", "info", "Начата обработка заказа")
+            logging.info(f"Purchase {purchase_id}: Started processing for {purchase['recipient_username']}")
+            # Списываем бонусы (при оплате бонусами они списаны при создании заказа)
+            if purchase["invoice_id"] != "bonus_payment" and purchase["user_id"] and purchase["bonus_stars_used"] > 0:
+                await db.update_bonus_balance(purchase["user_id"], -purchase["bonus_stars_used"], "bonus_spent", purchase_id)
+            await db.set_fulfillment_stage(purchase_id, "delivering")
+
+    # Если покупка уже оплачена бонусами
+    if purchase["invoice_id"] == "bonus_payment":
+        amount = purchase["amount"]
+    else:
+        amount = purchase["amount"] - int(purchase["bonus_stars_used"])  # Учитываем бонусы
+
+    if stage != "delivered":
+        if stage == "ready":
+            await db.set_fulfillment_stage(purchase_id, "delivering")
+        # Отправляем звезды через Fragment API, если есть что отправлять
+        if amount > 0:
+            # Заказы одному получателю в пределах окна объединяются в одну покупку
+            expect_more = await db.has_other_fulfillment_jobs(purchase_id, purchase["recipient_username"])
+            result = await fragment_service.submit_stars_purchase(amount, purchase["recipient_username"], expect_more)
+            if not result["success"] and result.get("retry"):
+                # Звезды не отправлялись: задание ждет пополнения кошелька, попытки не расходуются.
+                # Повтор - после следующего обновления баланса
+                await db.hold_fulfillment_job(purchase_id, time.time() + FRAGMENT_BALANCE_TTL, result["error"])
+                if stage != "ready":
+                    await notify(
+                        ADMIN_ID[0],
+                        f"<b>⚠️ Пополните кошелек Fragment</b>\n\n"
+                        f"Заказ #{purchase_id} ({amount} звёзд для @{purchase['recipient_username']}) ждет пополнения.\n"
+                        f"{result['error']}",
+                        parse_mode="HTML"
+                    )
+                logging.warning(f"Purchase {purchase_id}: On hold - {result['error']}")
+                return
+            if not result["success"]:
+                async with db.transaction():
+                    await db.update_purchase_status(purchase_id, "failed", error_message=result["error"])
+                    await db.log_transaction(purchase_id, "delivery_failed", "error", f"Ошибка: {result['error']}")
+                    await db.delete_fulfillment_job(purchase_id)
+                    # Отправляем уведомление об ошибке
+                    if purchase["user_id"]:
+                        await notify(purchase["user_id"], f"Покупка #{purchase_id} на {purchase['amount']} звезд не удалась: {result['error']}")
+                logging.error(f"Purchase {purchase_id}: Failed - {result['error']}")
+                return
+            transaction_id = result.get("transaction_id")
+            if result["batch_size"] > 1:
+                await db.log_transaction(purchase_id, "delivery_batched", "info", f"Доставлено одной покупкой с {result['batch_size'] - 1} другими заказами")
+        else:
+            transaction_id = purchase["invoice_id"]
+        await db.set_fulfillment_stage(purchase_id, "delivered", transaction_id)
+
+    # Если покупка успешна
+    async with db.transaction():
+        await db.update_purchase_status(purchase_id, "completed", transaction_id)
+        await db.log_transaction(purchase_id, "stars_delivered", "success", f"Transaction ID: {transaction_id}")
+        await db.delete_fulfillment_job(purchase_id)
+        # Отправляем уведомление об успехе
+        if purchase["user_id"]:
+            bonus_msg = f" (использовано {purchase['bonus_stars_used']:.2f} бонусов)" if purchase["bonus_stars_used"] > 0 else ""
+            await notify(
+                purchase["user_id"],
+                f"Покупка #{purchase_id} на {purchase['amount']} звезд успешно завершена!{bonus_msg} Звезды отправлены на @{purchase['recipient_username']}."
+            )
+
+        # Уведомляем администраторов
+        bonus_msg = f"\nИспользовано бонусов: {purchase['bonus_stars_used']:.2f} звёзд" if purchase["bonus_stars_used"] > 0 else ""
+        await notify(
+            ADMIN_ID[0],
+            f"<b>💰 Заказ выполнен!</b>\n\n"
+            f"Покупка ID: {purchase_id}\n"
+            f"Пользователь: {purchase['user_id'] or 'Неавторизован'}\n"
+            f"Товар: {purchase['amount']} Звёзд ⭐️\n"
+            f"Получатель: @{purchase['recipient_username']}\n"
+            f"Валюта: {purchase['currency']}\n"
+            f"Сумма: {purchase['price']:.2f}{bonus_msg}",
+            parse_mode="HTML"
+        )
+
+        # Начисление бонусов рефереру
+        await credit_referrer(db, purchase)
+    logging.info(f"Purchase {purchase_id}: Stars delivered")
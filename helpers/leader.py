@@ -0,0 +1,54 @@
+import asyncio
+import logging
+import os
+from config import LEADER_LOCK_PATH, LEADER_RETRY_INTERVAL
+
+try:
+    import fcntl
+except ImportError:  # Windows: файловых блокировок нет, процесс считается единственным
+    fcntl = None
+
+logging.basicConfig(filename="logs/site.log", level=logging.INFO)
+
+_lock_file = None  # Открытый файл блокировки, пока процесс - лидер
+
+def try_acquire_leadership() -> bool:
+    """
+    Неблокирующий захват блокировки LEADER_LOCK_PATH.
+
+    Блокировку снимает ОС при завершении процесса, поэтому после падения
+    лидера ее подхватывает один из оставшихся воркеров.
+    """
+    global _lock_file
+    if _lock_file is not None:
+        return True
+    lock_file = open(LEADER_LOCK_PATH, "a+")
+    if fcntl:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+    lock_file.seek(0)
+    lock_file.truncate()
+    lock_file.write(str(os.getpid()))  # PID лидера для диагностики
+    lock_file.flush()
+    _lock_file = lock_file
+    return True
+
+async def run_as_leader(start_tasks):
+    """Фоновая задача: ждет лидерства и один раз вызывает start_tasks()"""
+    while not try_acquire_leadership():
+        await asyncio.sleep(LEADER_RETRY_INTERVAL)
+    logging.info(f"Процесс {os.getpid()} получил блокировку {LEADER_LOCK_PATH}, запуск фоновых задач")
+    start_tasks()
+
+def is_leader() -> bool:
+    """Процесс владеет блокировкой и запустил фоновые задачи"""
+    return _lock_file is not None
+
+def release_leadership():
+    global _lock_file
+    if _lock_file is not None:
+        _lock_file.close()
+        _lock_file = None
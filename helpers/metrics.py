@@ -0,0 +1,103 @@
+import asyncio
+import inspect
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+from config import METRICS_LOOP_LAG_INTERVAL
+
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+LAG_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1)
+
+# Гистограммы: {имя: (описание, границы, {метки: [счетчики по корзинам + Inf, сумма]})}
+_histograms = {}
+_gauges = {}  # {имя: (описание, функция без аргументов)}
+
+def histogram(name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+    _histograms[name] = (help_text, buckets, {})
+
+def gauge(name: str, help_text: str, func):
+    """Значение считывается вызовом func() в момент запроса /metrics"""
+    _gauges[name] = (help_text, func)
+
+histogram("http_request_duration_seconds", "Время обработки HTTP-запроса")
+histogram("db_method_duration_seconds", "Время выполнения методов Database")
+histogram("outbound_request_duration_seconds", "Время запросов к внешним сервисам")
+histogram("event_loop_lag_seconds", "Задержка event loop относительно запланированного пробуждения", LAG_BUCKETS)
+
+def observe(name: str, value: float, **labels):
+    """Запись значения: O(log корзин), без блокировок - вызывается только из event loop"""
+    _, buckets, series = _histograms[name]
+    key = tuple(labels.items())
+    state = series.get(key)
+    if state is None:
+        state = series[key] = [[0] * (len(buckets) + 1), 0.0]
+    state[0][bisect_left(buckets, value)] += 1
+    state[1] += value
+
+@contextmanager
+def outbound(service: str, operation: str):
+    """Замер вызова внешнего сервиса с меткой outcome (ok/error)"""
+    started = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        observe("outbound_request_duration_seconds", time.perf_counter() - started,
+                service=service, operation=operation, outcome=outcome)
+
+def instrument_methods(cls, name: str, exclude: tuple = ()):
+    """Замер всех публичных async-методов класса с меткой method (кроме exclude - например, бесконечных циклов)"""
+    for attr, func in list(vars(cls).items()):
+        if attr.startswith("_") or attr in exclude or not inspect.iscoroutinefunction(func):
+            continue
+
+        def wrap(func, method):
+            @wraps(func)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    observe(name, time.perf_counter() - started, method=method)
+            return wrapper
+
+        setattr(cls, attr, wrap(func, attr))
+
+async def run_loop_lag_monitor():
+    """Фоновая задача каждого процесса: насколько позже срабатывает sleep(METRICS_LOOP_LAG_INTERVAL)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        started = loop.time()
+        await asyncio.sleep(METRICS_LOOP_LAG_INTERVAL)
+        observe("event_loop_lag_seconds", max(0.0, loop.time() - started - METRICS_LOOP_LAG_INTERVAL))
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+def render() -> str:
+    """Все метрики процесса в текстовом формате Prometheus"""
+    lines = []
+    for name, (help_text, buckets, series) in _histograms.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} histogram")
+        for labels, (counts, total) in list(series.items()):
+            cumulative = 0
+            for bound, count in zip(buckets + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+    for name, (help_text, func) in _gauges.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        lines.append(f"{name} {func()}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import time
+from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError, TelegramBadRequest
+from quart import current_app
+from config import ADMIN_ID, NOTIFY_BATCH_SIZE, NOTIFY_GLOBAL_RATE, NOTIFY_CHAT_INTERVAL, NOTIFY_MAX_ATTEMPTS
+from helpers.metrics import outbound
+
+logging.basicConfig(filename="logs/site.log", level=logging.INFO)
+
+MESSAGE_LIMIT = 4096  # Максимальная длина сообщения Telegram
+ADMIN_SEPARATOR = "\n\n➖➖➖➖➖\n\n"
+
+_wakeup = asyncio.Event()  # Будит отправителя при появлении новых сообщений
+_chat_ready_at = {}  # {chat_id: время, раньше которого в чат не пишем}
+
+async def notify(chat_id, text: str, parse_mode: str = None):
+    """Постановка сообщения в очередь отправки (outbox в SQLite), без ожидания Telegram"""
+    db = current_app.config["DB"]
+    try:
+        await db.enqueue_notification(int(chat_id), text, parse_mode)
+        _wakeup.set()
+    except Exception as e:
+        logging.error(f"Failed to enqueue notification for {chat_id}: {str(e)}")
+
+def _group_messages(messages: list) -> list:
+    """
+    Разбиение очереди на отправки: [(chat_id, text, parse_mode, [id, ...])]
+
+    Сообщения администраторам с одинаковым parse_mode склеиваются в одно,
+    пока оно помещается в лимит Telegram.
+    """
+    sends = []
+    admin_sends = {}
+    for message in messages:
+        chat_id, text, parse_mode = message["chat_id"], message["text"], message["parse_mode"]
+        if str(chat_id) in ADMIN_ID:
+            key = (chat_id, parse_mode)
+            current = admin_sends.get(key)
+            if current and len(current[1]) + len(ADMIN_SEPARATOR) + len(text) <= MESSAGE_LIMIT:
+                current[1] += ADMIN_SEPARATOR + text
+                current[3].append(message["id"])
+                continue
+            current = [chat_id, text, parse_mode, [message["id"]]]
+            admin_sends[key] = current
+            sends.append(current)
+        else:
+            sends.append([chat_id, text, parse_mode, [message["id"]]])
+    return sends
+
+async def run_notification_sender():
+    """Фоновая задача: отправка сообщений из outbox с ограничением частоты и повторами"""
+    db = current_app.config["DB"]
+    bot = current_app.config["BOT"]
+    while True:
+        try:
+            _wakeup.clear()
+            now = time.time()
+            messages = await db.get_due_notifications(now, NOTIFY_BATCH_SIZE)
+            if not messages:
+                try:
+                    await asyncio.wait_for(_wakeup.wait(), timeout=1)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            sent = 0
+            deferred = []  # Сообщения чатов на паузе: переносятся, чтобы не занимать пачку
+            for chat_id, text, parse_mode, ids in _group_messages(messages):
+                ready_at = _chat_ready_at.get(chat_id, 0)
+                if ready_at > time.time():
+                    deferred.extend((ready_at, id_) for id_ in ids)
+                    continue
+                try:
+                    with outbound("telegram", "sendMessage"):
+                        await bot.send_message(chat_id=chat_id, text=text, parse_mode=parse_mode)
+                    await db.delete_notifications(ids)
+                    _chat_ready_at[chat_id] = time.time() + NOTIFY_CHAT_INTERVAL
+                    sent += 1
+                except TelegramRetryAfter as e:
+                    logging.warning(f"Telegram rate limit for {chat_id}: retry after {e.retry_after}s")
+                    _chat_ready_at[chat_id] = time.time() + e.retry_after
+                    await db.reschedule_notifications(ids, time.time() + e.retry_after, str(e), count_attempt=False)
+                except (TelegramForbiddenError, TelegramBadRequest) as e:
+                    logging.error(f"Notification to {chat_id} dropped: {str(e)}")
+                    await db.delete_notifications(ids)
+                except Exception as e:
+                    attempts = max(message["attempts"] for message in messages if message["id"] in ids) + 1
+                    if attempts >= NOTIFY_MAX_ATTEMPTS:
+                        logging.error(f"Notification to {chat_id} dropped after {attempts} attempts: {str(e)}")
+                        await db.delete_notifications(ids)
+                    else:
+                        logging.error(f"Failed to send notification to {chat_id} (attempt {attempts}): {str(e)}")
+                        await db.reschedule_notifications(ids, time.time() + min(2 ** attempts, 300), str(e))
+                await asyncio.sleep(1 / NOTIFY_GLOBAL_RATE)
+            if deferred:
+                await db.defer_notifications(deferred)
+
+            # Прохода без единой отправки: все чаты на паузе, не крутим цикл вхолостую
+            if not sent:
+                await asyncio.sleep(NOTIFY_CHAT_INTERVAL)
+            # Освобождаем словарь от чатов, пауза которых давно прошла
+            if len(_chat_ready_at) > 10000:
+                now = time.time()
+                for chat_id in [chat_id for chat_id, ready_at in _chat_ready_at.items() if ready_at < now]:
+                    del _chat_ready_at[chat_id]
+        except Exception as e:
+            logging.error(f"Notification sender error: {str(e)}")
+            await asyncio.sleep(1)
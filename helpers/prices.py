@@ -0,0 +1,94 @@
+import aiohttp
+import asyncio
+import logging
+from datetime import datetime
+from config import PRICES_TTL, PRICES_REFRESH_INTERVAL, PRICES_REQUEST_TIMEOUT, PRICES_RETRY_BACKOFF
+from helpers.metrics import outbound
+
+logger = logging.getLogger(__name__)
+
+COINGECKO_URL = "https://api.coingecko.com/api/v3/simple/price?ids=the-open-network,tether&vs_currencies=rub"
+
+_star_prices_cache = {
+    "prices": {"TON": 0.0057, "USDT": 0.017},  # Запасные значения по умолчанию
+    "last_updated": None,  # Время последнего обновления
+    "last_failed": None  # Время последней неудачной попытки обновления
+}
+_session = None  # Общая сессия для запросов к CoinGecko
+_refresh_task = None  # Выполняющееся обновление (single-flight)
+
+def _get_session() -> aiohttp.ClientSession:
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=PRICES_REQUEST_TIMEOUT))
+    return _session
+
+async def get_star_prices() -> dict:
+    """
+    Текущая стоимость 1 звезды в TON и USDT, эквивалентная 1.38 RUB
+
+    Если кэш устарел, отвечает из кэша и запускает в фоне одно обновление на
+    всех (stale-while-revalidate). Пока цены ни разу не были получены, ждет
+    это обновление (не дольше PRICES_REQUEST_TIMEOUT): запасные значения
+    отдаются, только если CoinGecko не ответил, и без ожидания - в течение
+    PRICES_RETRY_BACKOFF после неудачной попытки.
+    """
+    last_updated = _star_prices_cache["last_updated"]
+    if not last_updated:
+        last_failed = _star_prices_cache["last_failed"]
+        if last_failed and (datetime.utcnow() - last_failed).total_seconds() < PRICES_RETRY_BACKOFF:
+            return _star_prices_cache["prices"]
+        return await asyncio.shield(schedule_price_refresh())
+    if (datetime.utcnow() - last_updated).total_seconds() >= PRICES_TTL:
+        schedule_price_refresh()
+    return _star_prices_cache["prices"]
+
+def schedule_price_refresh() -> asyncio.Task:
+    """Запуск обновления цен, если оно еще не выполняется"""
+    global _refresh_task
+    if _refresh_task is None or _refresh_task.done():
+        _refresh_task = asyncio.create_task(refresh_star_prices())
+    return _refresh_task
+
+def _fetch_failed() -> dict:
+    """Отметка неудачной попытки; возвращает кэш"""
+    _star_prices_cache["last_failed"] = datetime.utcnow()
+    return _star_prices_cache["prices"]
+
+async def refresh_star_prices() -> dict:
+    """Запрос курсов TON и USDT у CoinGecko и обновление кэша"""
+    STAR_PRICE_RUB = 1.38  # Цена 1 звезды в RUB
+    try:
+        with outbound("coingecko", "simple_price"):
+            async with _get_session().get(COINGECKO_URL) as response:
+                if response.status != 200:
+                    logger.error(f"Ошибка API CoinGecko: статус {response.status}")
+                    return _fetch_failed()
+                data = await response.json()
+        ton_rub = data.get("the-open-network", {}).get("rub", 0)
+        usdt_rub = data.get("tether", {}).get("rub", 0)
+        if ton_rub == 0 or usdt_rub == 0:
+            logger.error("Ошибка: нулевые курсы TON или USDT")
+            return _fetch_failed()
+        prices = {
+            "TON": STAR_PRICE_RUB / ton_rub,  # Кол-во TON за 1.38 RUB
+            "USDT": STAR_PRICE_RUB / usdt_rub  # Кол-во USDT за 1.38 RUB
+        }
+        # Обновляем кэш
+        _star_prices_cache["prices"] = prices
+        _star_prices_cache["last_updated"] = datetime.utcnow()
+        logger.info("Цены звезд успешно обновлены и закэшированы")
+        return prices
+    except Exception as e:
+        logger.error(f"Ошибка при получении курсов через CoinGecko: {e}")
+        return _fetch_failed()
+
+async def run_price_refresher():
+    """Фоновая задача: обновление цен заранее, до истечения PRICES_TTL"""
+    while True:
+        await schedule_price_refresh()
+        await asyncio.sleep(PRICES_REFRESH_INTERVAL)
+
+async def close_price_session():
+    if _session is not None and not _session.closed:
+        await _session.close()
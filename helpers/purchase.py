@@ -1,334 +1,262 @@
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from io import BytesIO
 import aiohttp
 import qrcode
+from qrcode.image.pure import PyPNGImage  # Требует pypng: pip install "qrcode[png]" (Pillow не нужен)
+from qrcode.image.svg import SvgPathImage
 from quart import current_app
 import logging
 import asyncio
-from config import ADMIN_ID, TON_WALLET_ADDRESS, TONCENTER_API_KEY
+from datetime import timedelta
+from config import TON_WALLET_ADDRESS, TONCENTER_API_KEY, TONCENTER_API_URL, TON_POLL_INTERVAL, TON_TRANSACTIONS_PAGE, TON_MAX_PAGES, QR_WORKERS, INVOICE_TTL, INVOICE_POLL_INTERVAL, CRYPTO_INVOICES_CHUNK, WEB_WORKERS
+from database import msk_now, timestamp
+from helpers.metrics import gauge, outbound
+from helpers.fulfillment import enqueue_fulfillment
+from helpers.leader import is_leader
+from helpers.notifications import notify
 
 logging.basicConfig(filename="logs/site.log", level=logging.INFO)
 
-last_checked_lt = 0
+last_checked_lt = 0  # Курсор TON-опросчика, зеркало строки poller_cursors
 last_checked_hash = ""
+# Кэши опросчиков живут только у лидера; остальные воркеры видят покупки через БД
 pending_ton_purchases = {}  # Кэш: {comment: purchase_id} для pending TON покупок
+open_invoices = {}  # Кэш: {invoice_id: purchase_id} для неоплаченных инвойсов CryptoPay
+QR_MEDIA_TYPES = {"svg": "image/svg+xml", "png": "image/png"}
+
+_qr_executor = ThreadPoolExecutor(max_workers=QR_WORKERS, thread_name_prefix="qr")
+
+gauge("open_invoices", "Неоплаченные инвойсы CryptoPay в кэше опросчика", lambda: len(open_invoices))
+gauge("pending_ton_comments", "Неоплаченные TON-покупки в кэше опросчика", lambda: len(pending_ton_purchases))
+
+def track_pending_purchase(purchase_id: int, invoice_id: str = None, comment: str = None):
+    """Новая покупка сразу попадает в кэш опросчика, если он работает в этом процессе"""
+    if not is_leader():
+        return  # Опросчик лидера подхватит покупку из БД в следующем проходе
+    if invoice_id:
+        open_invoices[invoice_id] = purchase_id
+    if comment:
+        pending_ton_purchases[comment] = purchase_id
 
 async def poll_ton_transactions():
-    """Фоновая задача для опроса транзакций TON каждые 5 секунд"""
+    """
+    Фоновая задача: опрос входящих TON-транзакций от последней обработанной (курсор хранится в БД).
+
+    Если за проход не удалось долистать до курсора (долгий простой или всплеск),
+    курсор не сдвигается: следующий проход продолжает листать вниз с самой
+    старой загруженной транзакции, пока разрыв не закроется.
+    """
     db = current_app.config["DB"]
     global last_checked_lt, last_checked_hash
-    processed_lt = set()  # Кэш для отслеживания обработанных lt
-    while True:
-        try:
-            async with aiohttp.ClientSession() as session:
-                params = {
-                    "address": TON_WALLET_ADDRESS,
-                    "limit": 20,  # Последние 20 транзакций
-                }
-                if TONCENTER_API_KEY:
-                    params["api_key"] = TONCENTER_API_KEY
-                
-                async with session.get(f"https://testnet.toncenter.com/api/v2/getTransactions", params=params) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        transactions = data.get("result", [])
-                        
-                        for tx in transactions:  # Обрабатываем в порядке API (от новых к старым)
-                            tx_lt = int(tx["transaction_id"]["lt"])
-                            
-                            # Пропускаем уже обработанные транзакции
-                            if tx_lt in processed_lt:
-                                continue
-                            
-                            in_msg = tx.get("in_msg", {})
-                            value_nano = int(in_msg["value"])
-                            value_ton = value_nano / 1e9
-                            comment = in_msg.get("message", "").strip()  # Комментарий (payload)
-                            if comment in pending_ton_purchases:
-                                purchase_id = pending_ton_purchases[comment]
-                                purchase = await db.get_purchase_by_id(str(purchase_id))
-                                
-                                if purchase and purchase["status"] == "pending":
-                                    expected_price = purchase["price"]
-                                    if abs(value_ton - expected_price) < 0.01:  # Допуск на fees
-                                        # Подтверждаем платеж
-                                        await db.update_purchase_status(purchase_id, "paid")
-                                        await db.log_transaction(
-                                            purchase_id,
-                                            "payment_confirmed",
-                                            "success",
-                                            f"TON платеж подтвержден: {value_ton} TON, tx_hash: {tx['transaction_id']['hash']}"
-                                        )
-                                        await db.update_purchase_status(purchase_id, "processing")
+    last_checked_lt, last_checked_hash = await db.get_poller_cursor("ton")
+    pending_ton_purchases.update(await db.get_pending_ton_comments())  # Восстанавливаем после перезапуска
+    backfill = None  # Незакрытый разрыв: {"start": (lt, hash) продолжения, "newest": (lt, hash) верха}
+    async with aiohttp.ClientSession() as session:
+        while True:
+            try:
+                if WEB_WORKERS > 1:
+                    # Покупки, созданные другими воркерами, видны только через БД
+                    pending_ton_purchases.update(await db.get_pending_ton_comments())
+                start = backfill["start"] if backfill else None
+                transactions, reached = await fetch_new_ton_transactions(session, last_checked_lt, start)
+                for tx in reversed(transactions):  # От старых к новым
+                    await match_ton_payment(db, tx)
+                if transactions:
+                    newest = backfill["newest"] if backfill else _tx_position(transactions[0])
+                    if reached:
+                        backfill = None
+                        last_checked_lt, last_checked_hash = newest
+                        await db.save_poller_cursor("ton", last_checked_lt, last_checked_hash)
+                    else:
+                        backfill = {"start": _tx_position(transactions[-1]), "newest": newest}
+                        logging.error(f"TON: до курсора lt={last_checked_lt} не долистали, продолжение с lt={backfill['start'][0]}")
+                elif backfill and reached:
+                    last_checked_lt, last_checked_hash = backfill["newest"]
+                    backfill = None
+                    await db.save_poller_cursor("ton", last_checked_lt, last_checked_hash)
+            except Exception as e:
+                logging.error(f"Ошибка при опросе TON транзакций: {e}")
 
-                                        del pending_ton_purchases[comment]
-                                        
-                                        # Запускаем обработку
-                                        asyncio.create_task(process_stars_purchase(purchase_id))
-                                        
-                                        # Удаляем из pending
-                                        del pending_ton_purchases[comment]
-                            
-                            # Отмечаем транзакцию как обработанную
-                            processed_lt.add(tx_lt)
-                        # Ограничиваем размер кэша
-                        if len(processed_lt) > 1000:
-                            processed_lt.clear()
-                                
-        except Exception as e:
-            logging.error(f"Ошибка при опросе TON транзакций: {e}")
-        
-        await asyncio.sleep(5)  # Каждые 5 секунд
+            await asyncio.sleep(TON_POLL_INTERVAL)
 
-async def generate_ton_qr_code(address: str, amount: float, comment: str) -> BytesIO:
-    """Генерация QR-кода для TON-платежа"""
+def _tx_position(tx: dict) -> tuple:
+    return int(tx["transaction_id"]["lt"]), tx["transaction_id"]["hash"]
 
-    # Конвертируем сумму из TON в нанотоны (1 TON = 10^9 нанотон)
-    amount_nanoton = int(amount * 1_000_000_000)
+async def fetch_new_ton_transactions(session: aiohttp.ClientSession, after_lt: int, start: tuple = None) -> tuple:
+    """
+    Транзакции кошелька новее after_lt (от новых к старым), постранично от самой
+    свежей или от start = (lt, hash), не более TON_MAX_PAGES страниц.
 
-    # Формируем TON URI
-    ton_uri = f"ton://transfer/{address}?amount={amount_nanoton}&text={comment}"
-    
-    # Создаем QR-код
+    Returns:
+        (транзакции, reached): reached = False, если до after_lt не долистали
+    """
+    transactions = []
+    params = {"address": TON_WALLET_ADDRESS, "limit": TON_TRANSACTIONS_PAGE}
+    if TONCENTER_API_KEY:
+        params["api_key"] = TONCENTER_API_KEY
+    skip_first = False
+    if start:
+        params["lt"], params["hash"] = str(start[0]), start[1]
+        skip_first = True  # Страница начинается с уже обработанной транзакции start
+    for _ in range(TON_MAX_PAGES):
+        with outbound("toncenter", "getTransactions"):
+            async with session.get(f"{TONCENTER_API_URL}/getTransactions", params=params) as response:
+                if response.status != 200:
+                    raise RuntimeError(f"Toncenter вернул статус {response.status}")
+                page = (await response.json()).get("result", [])
+        if skip_first and page:
+            page = page[1:]  # Страница начинается с транзакции, на которой закончилась предыдущая
+        skip_first = True
+        for tx in page:
+            if int(tx["transaction_id"]["lt"]) <= after_lt:
+                return transactions, True
+            transactions.append(tx)
+        if not after_lt or len(page) < TON_TRANSACTIONS_PAGE - 1:
+            return transactions, True  # При первом запуске достаточно последней страницы; история кончилась
+        oldest = transactions[-1]["transaction_id"]
+        params["lt"], params["hash"] = oldest["lt"], oldest["hash"]
+    return transactions, False
+
+async def match_ton_payment(db, tx: dict):
+    """Подтверждение покупки по комментарию и сумме входящей транзакции"""
+    in_msg = tx.get("in_msg") or {}
+    comment = (in_msg.get("message") or "").strip()  # Комментарий (payload)
+    purchase_id = pending_ton_purchases.get(comment)
+    if purchase_id is None:
+        return
+    value_ton = int(in_msg.get("value", 0)) / 1e9
+    # Проверка статуса и подтверждение - одна транзакция, чтобы не пересечься с отменой по таймауту
+    async with db.transaction():
+        purchase = await db.get_purchase_by_id(str(purchase_id))
+        if not purchase or purchase["status"] != "pending":
+            pending_ton_purchases.pop(comment, None)
+            return
+        if abs(value_ton - purchase["price"]) >= 0.01:  # Допуск на fees
+            return
+        # Подтверждаем платеж
+        await db.update_purchase_status(purchase_id, "paid")
+        await db.log_transaction(
+            purchase_id,
+            "payment_confirmed",
+            "success",
+            f"TON платеж подтвержден: {value_ton} TON, tx_hash: {tx['transaction_id']['hash']}"
+        )
+        await db.update_purchase_status(purchase_id, "processing")
+        await enqueue_fulfillment(db, purchase_id)  # Доставка - через очередь, вместе с подтверждением
+    pending_ton_purchases.pop(comment, None)
+
+@lru_cache(maxsize=256)
+def render_qr_code(data: str, image_format: str) -> bytes:
+    """Построение QR-кода в SVG или PNG без Pillow (выполняется в пуле потоков)"""
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
         box_size=10,
         border=4,
     )
-    qr.add_data(ton_uri)
+    qr.add_data(data)
     qr.make(fit=True)
-    
-    # Создаем изображение
-    img = qr.make_image(fill_color="black", back_color="white")
-    
-    # Сохраняем в BytesIO для отправки
-    img_byte_arr = BytesIO()
-    img.save(img_byte_arr, format='PNG')
-    img_byte_arr.seek(0)
-    
-    return img_byte_arr
 
-async def check_invoice_status(purchase_id: int, invoice_id: str):
-    """Проверка статуса инвойса каждые 2 секунды в течение 15 минут."""
-    crypto = current_app.config["CRYPTO"]
-    bot = current_app.config["BOT"]
-    db = current_app.config["DB"]
-    fragment_service = current_app.config["FRAGMENT"]
-    
-    try:
-        max_duration = 15 * 60  # 15 минут в секундах
-        interval = 5  # Интервал проверки: 2 секунды
-        max_attempts = max_duration // interval
-        attempt = 1
+    image_factory = SvgPathImage if image_format == "svg" else PyPNGImage
+    img = qr.make_image(image_factory=image_factory)
+    buffer = BytesIO()
+    img.save(buffer)
+    return buffer.getvalue()
 
-        while attempt <= max_attempts:
-            try:
-                purchase = await db.get_purchase_by_id(str(purchase_id))
-                if purchase["currency"] == "TON":
-                    if purchase["status"] in ["paid", "processing", "completed"]:
-                        return
-                else:
-                    invoices = await crypto.get_invoices(invoice_ids=[int(invoice_id)])
-                    if invoices[0].status == "paid":
-                        # Инвойс оплачен, запускаем обработку покупки
-                        await process_stars_purchase(purchase_id, invoice_id)
-                        return
-                    elif invoices[0].status in ["expired", "cancelled"]:
-                        # Инвойс истек или отменен
-                        await db.update_purchase_status(purchase_id, "cancelled", error_message=f"Invoice {invoices[0].status}")
-                        await db.log_transaction(purchase_id, "invoice_failed", "error", f"Invoice {invoices[0].status}")
-                        logging.error(f"Purchase {purchase_id}: Invoice {invoices[0].status}")
-                        # Удаляем инвойс
-                        try:
-                            await crypto.delete_invoice(int(invoice_id))
-                            logging.info(f"Purchase {purchase_id}: Invoice {invoice_id} deleted")
-                        except Exception as e:
-                            logging.error(f"Purchase {purchase_id}: Failed to delete invoice {invoice_id}: {str(e)}")
-                        # Отправляем уведомление об отмене
-                        if purchase and purchase.get("user_id"):
-                            try:
-                                await bot.send_message(
-                                    chat_id=purchase["user_id"],
-                                    text=f"Покупка #{purchase_id} на {purchase['amount']} звезд отменена: счет истек или был отменен."
-                                )
-                            except Exception as e:
-                                logging.error(f"Purchase {purchase_id}: Failed to send cancellation notification: {str(e)}")
-                        return
-                # Ждем 2 секунды перед следующей попыткой
-                await asyncio.sleep(interval)
-                attempt += 1
-            except Exception as e:
-                logging.error(f"Purchase {purchase_id}: Invoice check failed on attempt {attempt}: {str(e)}")
-                await db.log_transaction(purchase_id, "invoice_check_failed", "error", f"Attempt {attempt}, error: {str(e)}")
-                await asyncio.sleep(interval)
-                attempt += 1
-
-        # Если 15 минут истекли, отменяем покупку
-        if purchase['currency'] == "TON" and invoice_id in pending_ton_purchases:
-            await db.update_purchase_status(purchase_id, "cancelled", error_message="Invoice check timeout")
-            del pending_ton_purchases[invoice_id]
-        else:
-            await db.update_purchase_status(purchase_id, "cancelled", error_message="Invoice check timeout")
-            await db.log_transaction(purchase_id, "invoice_timeout", "error", "Invoice check timeout after 15 minutes")
-            logging.error(f"Purchase {purchase_id}: Invoice check timeout after {max_attempts} attempts")
-            try:
-                await crypto.delete_invoice(int(invoice_id))
-                logging.info(f"Purchase {purchase_id}: Invoice {invoice_id} deleted due to timeout")
-            except Exception as e:
-                logging.error(f"Purchase {purchase_id}: Failed to delete invoice {invoice_id}: {str(e)}")
-            # Отправляем уведомление об отмене
-            purchase = await db.get_purchase_by_id(str(purchase_id))
-            if purchase and purchase.get("user_id"):
-                try:
-                    await bot.send_message(
-                        chat_id=purchase["user_id"],
-                        text=f"Покупка #{purchase_id} на {purchase['amount']} звезд отменена: время ожидания оплаты (15 минут) истекло."
-                    )
-                except Exception as e:
-                    logging.error(f"Purchase {purchase_id}: Failed to send timeout notification: {str(e)}")
-    except Exception as e:
-        await db.update_purchase_status(purchase_id, "cancelled", error_message=f"Unexpected error: {str(e)}")
-        await db.log_transaction(purchase_id, "check_invoice_failed", "error", f"Unexpected error: {str(e)}")
-        logging.error(f"Purchase {purchase_id}: Check invoice failed - {str(e)}")
-        try:
-            await crypto.delete_invoice(int(invoice_id))
-            logging.info(f"Purchase {purchase_id}: Invoice {invoice_id} deleted due to unexpected error")
-        except Exception as e:
-            logging.error(f"Purchase {purchase_id}: Failed to delete invoice {invoice_id}: {str(e)}")
-        # Отправляем уведомление об ошибке
-        purchase = await db.get_purchase_by_id(str(purchase_id))
-        if purchase and purchase.get("user_id"):
-            try:
-                await bot.send_message(
-                    chat_id=purchase["user_id"],
-                    text=f"Покупка #{purchase_id} на {purchase['amount']} звезд не удалась: {str(e)}"
-                )
-            except Exception as e:
-                logging.error(f"Purchase {purchase_id}: Failed to send error notification: {str(e)}")
+async def generate_ton_qr_code(address: str, amount: float, comment: str, image_format: str = "png") -> bytes:
+    """Генерация QR-кода для TON-платежа"""
 
-async def process_stars_purchase(purchase_id: int, invoice_id: str = None):
-    """Обработка покупки звезд после подтверждения оплаты."""
-    crypto = current_app.config["CRYPTO"]
-    bot = current_app.config["BOT"]
-    db = current_app.config["DB"]
-    fragment_service = current_app.config["FRAGMENT"]
-    
-    try:
-        purchase = await db.get_purchase_by_id(str(purchase_id))
-        if not purchase:
-            logging.error(f"Purchase {purchase_id}: Not found")
-            return
-        await db.log_transaction(purchase_id, "processing_started", "info", "Начата обработка заказа")
-        logging.info(f"Purchase {purchase_id}: Started processing for {purchase['recipient_username']}")
+    # Конвертируем сумму из TON в нанотоны (1 TON = 10^9 нанотон)
+    amount_nanoton = int(amount * 1_000_000_000)
 
-        # Если покупка уже оплачена бонусами
-        if purchase["invoice_id"] == "bonus_payment":
-            amount = purchase["amount"]
-        else:
-            amount = purchase["amount"] - int(purchase["bonus_stars_used"])  # Учитываем бонусы
+    # Формируем TON URI
+    ton_uri = f"ton://transfer/{address}?amount={amount_nanoton}&text={comment}"
 
-        # Списываем бонусы
-        if purchase["user_id"]:
-            if purchase["bonus_stars_used"] > 0:
-                await db.update_bonus_balance(purchase["user_id"], -purchase["bonus_stars_used"])
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_qr_executor, render_qr_code, ton_uri, image_format)
 
-        # Отправляем звезды через Fragment API, если есть что отправлять
-        if amount > 0:
-            result = await fragment_service.process_stars_purchase(amount, purchase["recipient_username"])
-            if not result["success"]:
-                await db.update_purchase_status(purchase_id, "failed", error_message=result["error"])
-                await db.log_transaction(purchase_id, "delivery_failed", "error", f"Ошибка: {result['error']}")
-                logging.error(f"Purchase {purchase_id}: Failed - {result['error']}")
-                # Отправляем уведомление об ошибке
-                if purchase["user_id"]:
-                    try:
-                        await bot.send_message(
-                            chat_id=purchase["user_id"],
-                            text=f"Покупка #{purchase_id} на {purchase['amount']} звезд не удалась: {result['error']}"
-                        )
-                    except Exception as e:
-                        logging.error(f"Purchase {purchase_id}: Failed to send failure notification: {str(e)}")
-                return
-        else:
-            result = {"success": True, "transaction_id": purchase["invoice_id"]}
+async def poll_crypto_invoices():
+    """Фоновая задача: один запрос getInvoices на все открытые инвойсы и массовая отмена просроченных"""
+    db = current_app.config["DB"]
+    crypto = current_app.config["CRYPTO"]
+    open_invoices.update(await db.get_open_invoices())  # Восстанавливаем после перезапуска
+    while True:
+        try:
+            if WEB_WORKERS > 1:
+                open_invoices.update(await db.get_open_invoices())  # Инвойсы других воркеров
+            await check_open_invoices(crypto, db)
+        except Exception as e:
+            logging.error(f"Ошибка при опросе инвойсов CryptoPay: {e}")
+        try:
+            await expire_overdue_invoices(crypto, db)
+        except Exception as e:
+            logging.error(f"Ошибка при отмене просроченных инвойсов: {e}")
+        await asyncio.sleep(INVOICE_POLL_INTERVAL)
 
-        # Если покупка успешна
-        await db.update_purchase_status(purchase_id, "completed", result.get("transaction_id"))
-        await db.log_transaction(purchase_id, "stars_delivered", "success", f"Transaction ID: {result.get('transaction_id')}")
-        logging.info(f"Purchase {purchase_id}: Stars delivered")
-        # Отправляем уведомление об успехе
-        if purchase["user_id"]:
+async def check_open_invoices(crypto, db):
+    """Проверка статусов всех открытых инвойсов пачками по CRYPTO_INVOICES_CHUNK"""
+    invoice_ids = list(open_invoices)
+    for start in range(0, len(invoice_ids), CRYPTO_INVOICES_CHUNK):
+        chunk = invoice_ids[start:start + CRYPTO_INVOICES_CHUNK]
+        with outbound("cryptopay", "getInvoices"):
+            invoices = await crypto.get_invoices(invoice_ids=[int(invoice_id) for invoice_id in chunk], count=len(chunk))
+        for invoice in invoices or []:
+            invoice_id = str(invoice.invoice_id)
+            purchase_id = open_invoices.get(invoice_id)
+            if purchase_id is None:
+                continue
+            if invoice.status not in ("paid", "expired", "cancelled"):
+                continue
+            # Инвойс убирается из кэша только после фиксации: при ошибке он проверится в следующем проходе.
+            # Проверка статуса и переход - одна транзакция, как в match_ton_payment: запись кэша
+            # могла устареть (заказ уже завершен или отменен другим процессом)
             try:
-                bonus_msg = f" (использовано {purchase['bonus_stars_used']:.2f} бонусов)" if purchase["bonus_stars_used"] > 0 else ""
-                await bot.send_message(
-                    chat_id=purchase["user_id"],
-                    text=f"Покупка #{purchase_id} на {purchase['amount']} звезд успешно завершена!{bonus_msg} Звезды отправлены на @{purchase['recipient_username']}."
-                )
+                async with db.transaction():
+                    purchase = await db.get_purchase_by_id(str(purchase_id))
+                    pending = purchase is not None and purchase["status"] == "pending"
+                    if pending and invoice.status == "paid":
+                        await db.update_purchase_status(purchase_id, "paid")
+                        await db.log_transaction(purchase_id, "payment_confirmed", "success", f"Инвойс {invoice_id} оплачен")
+                        await enqueue_fulfillment(db, purchase_id)
+                    elif pending:
+                        await db.update_purchase_status(purchase_id, "cancelled", error_message=f"Invoice {invoice.status}")
+                        await db.log_transaction(purchase_id, "invoice_failed", "error", f"Invoice {invoice.status}")
+                        await notify_cancelled(purchase, "счет истек или был отменен")
+                open_invoices.pop(invoice_id, None)
+                if pending and invoice.status != "paid":
+                    logging.error(f"Purchase {purchase_id}: Invoice {invoice.status}")
+                    await delete_invoice(crypto, purchase_id, invoice_id)
             except Exception as e:
-                logging.error(f"Purchase {purchase_id}: Failed to send success notification: {str(e)}")
+                logging.error(f"Purchase {purchase_id}: не удалось обработать инвойс {invoice_id} ({invoice.status}): {e}")
 
-        # Уведомляем администраторов
-        try:
-            bonus_msg = f"\nИспользовано бонусов: {purchase['bonus_stars_used']:.2f} звёзд" if purchase["bonus_stars_used"] > 0 else ""
-            await bot.send_message(
-                chat_id=ADMIN_ID[0],
-                text=f"<b>💰 Заказ выполнен!</b>\n\n"
-                     f"Покупка ID: {purchase_id}\n"
-                     f"Пользователь: {purchase['username']}\n"
-                     f"Товар: {purchase['amount']} Звёзд ⭐️\n"
-                     f"Получатель: @{purchase['recipient_username']}\n"
-                     f"Валюта: {purchase['currency']}\n"
-                     f"Сумма: {purchase['price']:.2f}{bonus_msg}",
-                parse_mode="HTML"
-            )
-        except Exception as e:
-            logging.error(f"Purchase {purchase_id}: Failed to send admin notification: {str(e)}")
-
-        # Начисление бонусов рефереру
-        if purchase["user_id"]:
-            referrer_id = await db.get_referrer_id(purchase["user_id"])
-            if referrer_id:
-                level_rewards = {1: 0.02, 2: 0.04, 3: 0.06, 4: 0.08, 5: 0.10}
-                user = await db.get_user(purchase["user_id"])
-                purchased_stars = purchase["amount"]
-                
-                if user["referrer_id"]:
-                    referrer_id = user["referrer_id"]
-                    referrer = await db.get_user(referrer_id)
-                    if referrer:
-                        current_level = referrer["referral_level"]
-                        bonus_stars = purchased_stars * level_rewards[current_level]
-                        total_referral_stars = await db.get_total_referral_stars(referrer_id) + purchased_stars
-                        
-                        # Обновляем звезды рефералов и проверяем переход на следующий уровень
-                        new_level = min(5, (total_referral_stars // 5000) + 1)
-                        await db.update_referral_level(referrer_id, new_level, total_referral_stars)
-                        
-                        # Начисляем бонусные звезды
-                        await db.update_bonus_balance(referrer_id, bonus_stars)
-                        try:
-                            await bot.send_message(
-                                referrer_id,
-                                f"<b>🎁 Новые бонусы!</b>\n\n"
-                                f"Ваш реферал @{user['username']} купил {purchased_stars} звёзд.\n"
-                                f"Вам начислено {bonus_stars:.2f} бонусных звёзд (уровень {current_level}: {level_rewards[current_level]*100}%).\n"
-                                f"{'🎉 Поздравляем! Уровень повышен до ' + str(new_level) + '!' if new_level > current_level else ''}",
-                                parse_mode="HTML"
-                            )
-                        except Exception as e:
-                            logging.error(f"Purchase {purchase_id}: Failed to send referral bonus notification to {referrer_id}: {str(e)}")
+async def expire_overdue_invoices(crypto, db):
+    """Отмена одним запросом всех покупок, не оплаченных за INVOICE_TTL"""
+    created_before = timestamp(msk_now() - timedelta(seconds=INVOICE_TTL))
+    async with db.transaction():
+        expired = await db.expire_pending_purchases(created_before, "Invoice check timeout")
+        for purchase in expired:
+            await db.log_transaction(purchase["id"], "invoice_timeout", "error", f"Invoice check timeout after {INVOICE_TTL // 60} minutes")
+            await notify_cancelled(purchase, f"время ожидания оплаты ({INVOICE_TTL // 60} минут) истекло")
+    for purchase in expired:
+        logging.error(f"Purchase {purchase['id']}: Invoice check timeout")
+        if purchase["currency"] == "TON":
+            pending_ton_purchases.pop(purchase["comment"], None)
+        elif purchase["invoice_id"]:
+            open_invoices.pop(purchase["invoice_id"], None)
+            await delete_invoice(crypto, purchase["id"], purchase["invoice_id"])
 
+async def delete_invoice(crypto, purchase_id: int, invoice_id: str):
+    """Удаление инвойса в CryptoPay"""
+    try:
+        with outbound("cryptopay", "deleteInvoice"):
+            await crypto.delete_invoice(int(invoice_id))
+        logging.info(f"Purchase {purchase_id}: Invoice {invoice_id} deleted")
     except Exception as e:
-        await db.update_purchase_status(purchase_id, "failed", error_message=str(e))
-        await db.log_transaction(purchase_id, "processing_failed", "error", f"Ошибка: {str(e)}")
-        logging.error(f"Purchase {purchase_id}: Failed - {str(e)}")
-        # Отправляем уведомление об ошибке
-        purchase = await db.get_purchase_by_id(str(purchase_id))
-        if purchase and purchase["user_id"]:
-            try:
-                await bot.send_message(
-                    chat_id=purchase["user_id"],
-                    text=f"Покупка #{purchase_id} на {purchase['amount']} звезд не удалась: {str(e)}"
-                )
-            except Exception as e:
-                logging.error(f"Purchase {purchase_id}: Failed to send error notification: {str(e)}")
\ No newline at end of file
+        logging.error(f"Purchase {purchase_id}: Failed to delete invoice {invoice_id}: {str(e)}")
+
+async def notify_cancelled(purchase: dict, reason: str):
+    """Уведомление пользователя об отмене покупки"""
+    if not purchase or not purchase.get("user_id"):
+        return
+    await notify(purchase["user_id"], f"Покупка #{purchase['id']} на {purchase['amount']} звезд отменена: {reason}.")
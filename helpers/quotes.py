@@ -0,0 +1,39 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import time
+from dotenv import load_dotenv
+from config import QUOTE_TTL
+
+load_dotenv()
+
+# Ключ подписи котировок; без BOT_TOKEN - случайный ключ на время жизни процесса
+_quote_key = hmac.new(b"StarsQuote", (os.getenv("BOT_TOKEN") or "").encode() or os.urandom(32), hashlib.sha256).digest()
+
+def _sign(payload: bytes) -> str:
+    return base64.urlsafe_b64encode(hmac.new(_quote_key, payload, hashlib.sha256).digest()).decode().rstrip("=")
+
+def issue_quote(prices: dict, user_id=None) -> str:
+    """Подписанный ID котировки: цены за 1 звезду, закрепленные за пользователем на QUOTE_TTL секунд"""
+    payload = json.dumps(
+        {"p": prices, "u": str(user_id) if user_id else None, "e": int(time.time()) + QUOTE_TTL},
+        separators=(",", ":")
+    ).encode()
+    encoded = base64.urlsafe_b64encode(payload).decode().rstrip("=")
+    return f"{encoded}.{_sign(payload)}"
+
+def read_quote(quote_id: str, user_id=None):
+    """Цены из котировки, либо None, если подпись неверна, срок истек или котировка чужая"""
+    try:
+        encoded, signature = quote_id.split(".", 1)
+        payload = base64.urlsafe_b64decode(encoded + "=" * (-len(encoded) % 4))
+        if not hmac.compare_digest(signature, _sign(payload)):
+            return None
+        quote = json.loads(payload)
+    except (ValueError, AttributeError):
+        return None
+    if quote["e"] < time.time() or quote["u"] != (str(user_id) if user_id else None):
+        return None
+    return quote["p"]
@@ -0,0 +1,42 @@
+import time
+from functools import wraps
+from quart import jsonify, request
+from config import TRUST_PROXY_HEADERS, RATE_LIMIT_MAX_CLIENTS
+
+_hits = {}  # {(маршрут, IP): [начало окна, количество запросов]}
+
+def client_ip() -> str:
+    """IP клиента; за обратным прокси - последний адрес X-Forwarded-For (его добавляет прокси)"""
+    forwarded = request.headers.get("X-Forwarded-For")
+    if TRUST_PROXY_HEADERS and forwarded:
+        return forwarded.split(",")[-1].strip()
+    return request.remote_addr
+
+def _prune(now: float, window: float):
+    for key, (started, _) in list(_hits.items()):
+        if now - started >= window:
+            del _hits[key]
+
+def rate_limit(limit: int, window: float):
+    """
+    Декоратор маршрута: не более limit запросов с одного IP за window секунд,
+    сверх лимита - 429 с Retry-After. Счетчики у каждого процесса свои.
+    """
+    def decorator(func):
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            now = time.monotonic()
+            key = (func.__name__, client_ip())
+            state = _hits.get(key)
+            if state is None or now - state[0] >= window:
+                if len(_hits) >= RATE_LIMIT_MAX_CLIENTS:
+                    _prune(now, window)
+                state = _hits[key] = [now, 0]
+            state[1] += 1
+            if state[1] > limit:
+                response = jsonify({"error": "Too many requests"})
+                response.headers["Retry-After"] = str(int(window - (now - state[0])) + 1)
+                return response, 429
+            return await func(*args, **kwargs)
+        return wrapper
+    return decorator
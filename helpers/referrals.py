@@ -0,0 +1,51 @@
+import logging
+from config import REFERRAL_LEVELS
+from helpers.notifications import notify
+
+logging.basicConfig(filename="logs/site.log", level=logging.INFO)
+
+# Таблица уровней разбирается один раз при импорте
+LEVEL_THRESHOLDS = tuple((level, threshold) for level, threshold, _ in REFERRAL_LEVELS)
+LEVEL_REWARDS = {level: reward for level, _, reward in REFERRAL_LEVELS}
+
+def level_for(total_referral_stars: int) -> int:
+    """Реферальный уровень по количеству звезд, купленных рефералами"""
+    return max((level for level, threshold in LEVEL_THRESHOLDS if total_referral_stars >= threshold), default=1)
+
+async def credit_referrer(db, purchase: dict):
+    """
+    Начисление рефереру покупателя вознаграждения за завершенную покупку.
+
+    Накопленный итог и новый уровень вычисляются одним upsert; ставка
+    берется по уровню до покупки. Вызывается внутри транзакции завершения.
+    """
+    if not purchase["user_id"]:
+        return
+    info = await db.get_referral_info(purchase["user_id"])
+    if not info:
+        return
+    referrer_id = info["referrer_id"]
+    purchased_stars = purchase["amount"]
+
+    result = await db.add_referral_stars(referrer_id, purchased_stars, LEVEL_THRESHOLDS)
+    current_level = level_for(result["total_referral_stars"] - purchased_stars)
+    new_level = result["level"]
+    reward_rate = LEVEL_REWARDS.get(current_level, 0)
+    bonus_stars = purchased_stars * reward_rate
+
+    # Начисляем бонусные звезды
+    await db.update_bonus_balance(referrer_id, bonus_stars, "referral_reward", purchase["id"])
+    await notify(
+        referrer_id,
+        f"<b>🎁 Новые бонусы!</b>\n\n"
+        f"Ваш реферал @{info['username']} купил {purchased_stars} звёзд.\n"
+        f"Вам начислено {bonus_stars:.2f} бонусных звёзд (уровень {current_level}: {reward_rate*100}%).\n"
+        f"{'🎉 Поздравляем! Уровень повышен до ' + str(new_level) + '!' if new_level > current_level else ''}",
+        parse_mode="HTML"
+    )
+
+async def rebuild_referral_levels(db) -> int:
+    """Пересчет уровней и итогов всех рефереров по таблице purchases"""
+    updated = await db.rebuild_referral_levels(LEVEL_THRESHOLDS)
+    logging.info(f"Referral levels rebuilt: {updated} referrers")
+    return updated
@@ -0,0 +1,20 @@
+"""
+Пересчет referral_levels всех пользователей по завершенным покупкам рефералов.
+
+Запуск: python recompute_referrals.py
+"""
+import asyncio
+from database import Database
+from helpers.referrals import rebuild_referral_levels
+
+async def main():
+    db = Database()
+    await db.connect()
+    try:
+        updated = await rebuild_referral_levels(db)
+        print(f"Пересчитано рефереров: {updated}")
+    finally:
+        await db.close()
+
+if __name__ == "__main__":
+    asyncio.run(main())
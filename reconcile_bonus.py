@@ -0,0 +1,23 @@
+"""
+Пересчет бонусных балансов из журнала bonus_ledger.
+
+Запуск: python reconcile_bonus.py [--batch-size 500]
+"""
+import argparse
+import asyncio
+from database import Database
+
+async def main(batch_size: int):
+    db = Database()
+    await db.connect()
+    try:
+        fixed = await db.reconcile_bonus_balances(batch_size=batch_size)
+        print(f"Исправлено балансов: {fixed}")
+    finally:
+        await db.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Пересчет бонусных балансов из журнала")
+    parser.add_argument("--batch-size", type=int, default=500, help="Количество строк в одной транзакции")
+    args = parser.parse_args()
+    asyncio.run(main(args.batch_size))
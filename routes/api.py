@@ -1,17 +1,22 @@
-import base64
+import hashlib
 import time
 from uuid import uuid4
-from quart import Blueprint, request, jsonify, current_app, make_response
-from helpers.purchase import check_invoice_status, generate_ton_qr_code, process_stars_purchase, pending_ton_purchases
-from config import TON_WALLET_ADDRESS, get_star_prices, SUPPORT_URL, ADMIN_ID
+from quart import Blueprint, request, jsonify, current_app, make_response, g
+from helpers.auth import require_tg_user
+from helpers.notifications import notify
+from helpers.events import subscribe, unsubscribe, TERMINAL_STATUSES
+from helpers.fulfillment import enqueue_fulfillment
+from helpers.purchase import generate_ton_qr_code, track_pending_purchase, QR_MEDIA_TYPES
+from helpers.prices import get_star_prices
+from helpers.quotes import issue_quote, read_quote
+from helpers.metrics import outbound
+from helpers.ratelimit import rate_limit
+from config import TON_WALLET_ADDRESS, SUPPORT_URL, ADMIN_ID, STATISTICS_CACHE_TTL, INVOICE_TTL, EVENTS_KEEPALIVE, QUOTE_TTL, PURCHASES_PAGE_SIZE, PURCHASES_PAGE_MAX, RECIPIENT_RATE_LIMIT, RECIPIENT_RATE_WINDOW
 import asyncio
-import os
 from dotenv import load_dotenv
-import hmac
-import hashlib
 import json
 import logging
-from urllib.parse import quote, unquote
+from urllib.parse import quote
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, filename="logs/site.log")
@@ -21,76 +26,16 @@ load_dotenv()
 
 api = Blueprint("api", __name__)
 
-def verify_init_data(init_data_raw: str) -> dict:
-    """Проверка подлинности initData от Telegram Web App с URL-декодированием."""
-    try:
-        bot_token = os.getenv("BOT_TOKEN")
-        if not bot_token:
-            return {"error": "BOT_TOKEN не настроен"}
-        
-        # URL-декодирование initData
-        try:
-            init_data_decoded = unquote(init_data_raw)
-        except Exception as e:
-            return {"error": f"Неверный формат initData: {str(e)}"}
+_statistics_cache = {"data": None, "expires_at": 0.0}  # Кэш ответа /api/statistics
 
-        # Парсинг параметров
-        params = {}
-        pairs = init_data_decoded.split("&")
-        for pair in pairs:
-            if "=" in pair:
-                key, value = pair.split("=", 1)
-                params[key] = value
-        
-        # Извлечение хеша
-        received_hash = params.pop("hash", None)
-        if not received_hash:
-            return {"error": "Отсутствует hash в данных"}
-        
-        # Создание секретного ключа
-        secret_key = hmac.new(b"WebAppData", bot_token.encode(), hashlib.sha256).digest()
-        
-        # Создание строки для проверки
-        data_check_string = "\n".join(f"{k}={v}" for k, v in sorted(params.items()))
-        
-        # Вычисление хеша
-        computed_hash = hmac.new(secret_key, data_check_string.encode(), hashlib.sha256).hexdigest()
-        
-        # Проверка хеша
-        if computed_hash != received_hash:
-            return {"error": "Неверный hash в данных"}
-        
-        # Извлечение данных пользователя
-        user_str = params.get("user")
-        if not user_str:
-            return {"error": "Отсутствует параметр user"}
-        
-        try:
-            user = json.loads(user_str)
-            return {
-                "user_id": user.get("id"),
-                "username": user.get("username", "").lstrip("@"),
-                "first_name": user.get("first_name"),
-                "last_name": user.get("last_name")
-            }
-        except json.JSONDecodeError:
-            return {"error": "Неверный формат данных пользователя"}
-    except Exception as e:
-        return {"error": f"Ошибка проверки initData: {str(e)}"}
+class InsufficientBonusError(Exception):
+    """Бонусов не хватило при списании: заказ, оплаченный бонусами, откатывается"""
 
 @api.route("/verify-init", methods=["POST"])
+@require_tg_user
 async def verify_init():
     """Проверка initData от Telegram Web App."""
-    data = await request.get_json()
-    init_data = data.get("initData")
-    if not init_data:
-        return jsonify({"error": "No initData provided"}), 400
-    
-    result = verify_init_data(init_data)
-    if "error" in result:
-        logger.error(f"Verify initData failed: {result['error']}")
-        return jsonify(result), 400
-    
+    result = g.tg_user
     db = current_app.config["DB"]
     user_id = result["user_id"]
     username = result["username"]
@@ -135,20 +80,16 @@ async def verify_token():
         return jsonify({"error": str(e)}), 500
 
 @api.route("/prices", methods=["POST"])
+@require_tg_user(optional=True)
 async def get_prices():
     """Получение цен на звезды с учетом бонусной скидки."""
     try:
         data = await request.get_json()
-        init_data = data.get("initData")
         user_id = data.get("user_id")
         
-        # Проверяем initData, если предоставлен
-        if init_data:
-            result = verify_init_data(init_data)
-            if "error" in result:
-                logger.error(f"Verify initData failed: {result['error']}")
-                return jsonify({"error": result["error"]}), 400
-            user_id = result["user_id"]
+        # Пользователь из initData, если он был предоставлен
+        if g.tg_user:
+            user_id = g.tg_user["user_id"]
         
         prices = await get_star_prices()
         response = {}
@@ -157,9 +98,9 @@ async def get_prices():
         # Если пользователь авторизован, учитываем бонусы
         if user_id:
             db = current_app.config["DB"]
-            user = await db.get_user(user_id)
+            user = await db.get_user_profile(user_id)
             if user and user["username"]:
-                bonus_balance = await db.get_bonus_balance(user_id)
+                bonus_balance = user["bonus_balance"]
                 for currency, price_per_star in prices.items():
                     # Считаем максимальную скидку для данного количества звезд
                     max_discount = min(bonus_balance * price_per_star, amount * price_per_star)
@@ -187,6 +128,44 @@ async def get_prices():
         logger.error(f"Error getting prices: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@api.route("/quote", methods=["POST"])
+@require_tg_user(optional=True)
+async def get_quote():
+    """
+    Котировка для выбора количества звезд: цены за 1 звезду и бонусный баланс.
+
+    Итоговую стоимость клиент считает сам; quote_id фиксирует цены на
+    QUOTE_TTL секунд и передается в /api/purchase.
+    """
+    try:
+        data = await request.get_json(silent=True) or {}
+        user_id = g.tg_user["user_id"] if g.tg_user else data.get("user_id")
+        prices = await get_star_prices()
+        bonus_balance = 0
+
+        # Бонусы учитываются только для пользователей с username, как в /api/prices
+        if user_id:
+            db = current_app.config["DB"]
+            user = await db.get_user_profile(user_id)
+            if user and user["username"]:
+                bonus_balance = user["bonus_balance"]
+
+        return jsonify({
+            "quote_id": issue_quote(prices, user_id),
+            "prices": prices,
+            "bonus_balance": bonus_balance,
+            "expires_in": QUOTE_TTL
+        })
+    except Exception as e:
+        logger.error(f"Error creating quote: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
+@api.route("/recipient/<username>", methods=["GET"])
+@rate_limit(RECIPIENT_RATE_LIMIT, RECIPIENT_RATE_WINDOW)
+async def get_recipient(username):
+    """Проверка получателя звезд при вводе username: valid = true / false / null (не удалось проверить)."""
+    return jsonify(await current_app.config["FRAGMENT"].check_recipient(username))
+
 @api.route("/bonus_balance", methods=["POST"])
 async def get_bonus_balance():
     """Получение бонусного баланса пользователя."""
@@ -210,16 +189,28 @@ async def create_purchase():
     recipient_username = data.get("recipient_username")
     currency = data.get("currency")
     user_id = data.get("user_id")  # Может быть None для неавторизованных пользователей
+    quote_id = data.get("quote_id")
     
     if not all([amount, recipient_username, currency]):
         return jsonify({"error": "Missing required fields"}), 400
     if amount < 1:
         return jsonify({"error": "Минимальное количество звезд: 1"}), 400
     
+    # Получатель проверяется до создания счета, а не при доставке после оплаты;
+    # при занятом пуле проверок покупка ждет свободного потока
+    recipient = await current_app.config["FRAGMENT"].check_recipient(recipient_username, wait=True)
+    if recipient["valid"] is False:
+        return jsonify({"error": recipient["error"]}), 400
+    
     crypto = current_app.config["CRYPTO"]
     db = current_app.config["DB"]
-    bot = current_app.config["BOT"]
-    prices = await get_star_prices()
+    if quote_id:
+        # Цены, которые пользователь видел при выборе количества
+        prices = read_quote(quote_id, user_id)
+        if prices is None:
+            return jsonify({"error": "Quote expired or invalid"}), 400
+    else:
+        prices = await get_star_prices()
     if currency not in prices:
         return jsonify({"error": "Unsupported currency"}), 400
     
@@ -230,11 +221,12 @@ async def create_purchase():
         bonus_discount = 0.0
         bonus_applied = False
         
-        # Проверяем бонусный баланс, если пользователь авторизован и покупает для себя
+        # Проверяем бонусный баланс, если пользователь авторизован и покупает для себя.
+        # Баланс читается мимо кэша: его списывают и начисляют другие процессы
         if user_id:
-            user = await db.get_user(user_id)
+            user = await db.get_user_profile(user_id, fresh=True)
             if user and user["username"] and recipient_username.lower().lstrip("@") == user["username"].lower().lstrip("@"):
-                bonus_balance = await db.get_bonus_balance(user_id)
+                bonus_balance = user["bonus_balance"]
                 if bonus_balance > 0:
                     bonus_applied = True
                     bonus_discount = min(bonus_balance * prices[currency], price)
@@ -243,71 +235,71 @@ async def create_purchase():
 
         # Если бонусов хватает на весь заказ
         if price <= 0.001:
-            purchase_id = await db.create_purchase(
-                user_id=user_id or 0,
-                item_type="stars",
-                amount=amount,
-                recipient_username=recipient_username.lstrip("@"),
-                currency=currency,
-                price=0.0,
-                invoice_id="bonus_payment",
-                bonus_stars_used=bonus_stars_used,
-                bonus_discount=bonus_discount
-            )
-            # Списываем бонусы
-            if bonus_stars_used > 0:
-                await db.update_bonus_balance(user_id, -bonus_stars_used)
-                await db.log_transaction(
-                    purchase_id,
-                    "bonus_payment",
-                    "success",
-                    f"Заказ оплачен бонусами: {bonus_stars_used:.2f} звёзд"
+            # Заказ, списание бонусов, статусы и уведомления фиксируются одной транзакцией
+            async with db.transaction():
+                purchase_id = await db.create_purchase(
+                    user_id=user_id or 0,
+                    item_type="stars",
+                    amount=amount,
+                    recipient_username=recipient_username.lstrip("@"),
+                    currency=currency,
+                    price=0.0,
+                    invoice_id="bonus_payment",
+                    bonus_stars_used=bonus_stars_used,
+                    bonus_discount=bonus_discount
                 )
-            # Обновляем статус
-            await db.update_purchase_status(purchase_id, "paid")
-            await db.update_purchase_status(purchase_id, "processing")
-            # Уведомляем пользователя
-            if user_id:
-                try:
-                    bonus_msg = f"\nИспользовано бонусов: {bonus_stars_used:.2f} звёзд\nОстаток бонусов: {(await db.get_bonus_balance(user_id)):.2f} звёзд" if bonus_applied else ""
-                    await bot.send_message(
-                        chat_id=user_id,
-                        text=f"<b>✅ Заказ оплачен бонусами!</b>\n\n"
-                             f"Товар: {amount} Звёзд ⭐️\n"
-                             f"Получатель: @{recipient_username.lstrip('@')}\n"
-                             f"{bonus_msg}\n"
-                             f"⚙️ Обрабатываем ваш заказ...",
-                        parse_mode="HTML"
+                # Списываем бонусы; если баланс успел уменьшиться, заказ откатывается
+                if bonus_stars_used > 0:
+                    if not await db.spend_bonus_balance(user_id, bonus_stars_used, "bonus_payment", purchase_id):
+                        raise InsufficientBonusError()
+                    await db.log_transaction(
+                        purchase_id,
+                        "bonus_payment",
+                        "success",
+                        f"Заказ оплачен бонусами: {bonus_stars_used:.2f} звёзд"
                     )
-                except Exception as e:
-                    logger.error(f"Purchase {purchase_id}: Failed to send bonus payment notification: {str(e)}")
-            # Уведомляем администраторов
-            try:
+                # Обновляем статус
+                await db.update_purchase_status(purchase_id, "paid")
+                await db.update_purchase_status(purchase_id, "processing")
+                await enqueue_fulfillment(db, purchase_id)  # Доставка - через очередь
+                # Уведомляем пользователя
+                if user_id:
+                    try:
+                        bonus_msg = f"\nИспользовано бонусов: {bonus_stars_used:.2f} звёзд\nОстаток бонусов: {(await db.get_bonus_balance(user_id)):.2f} звёзд" if bonus_applied else ""
+                        await notify(
+                            user_id,
+                            f"<b>✅ Заказ оплачен бонусами!</b>\n\n"
+                            f"Товар: {amount} Звёзд ⭐️\n"
+                            f"Получатель: @{recipient_username.lstrip('@')}\n"
+                            f"{bonus_msg}\n"
+                            f"⚙️ Обрабатываем ваш заказ...",
+                            parse_mode="HTML"
+                        )
+                    except Exception as e:
+                        logger.error(f"Purchase {purchase_id}: Failed to send bonus payment notification: {str(e)}")
+                # Уведомляем администраторов
                 bonus_msg = f"\nИспользовано бонусов: {bonus_stars_used:.2f} звёзд" if bonus_applied else ""
-                await bot.send_message(
-                    chat_id=ADMIN_ID[0],
-                    text=f"<b>💰 Заказ оплачен бонусами!</b>\n\n"
-                         f"Покупка ID: {purchase_id}\n"
-                         f"Пользователь: {user_id or 'Неавторизован'}\n"
-                         f"Товар: {amount} Звёзд ⭐️\n"
-                         f"Получатель: @{recipient_username.lstrip('@')}\n"
-                         f"{bonus_msg}\n"
-                         f"🔄 Начинаем обработку заказа...",
+                await notify(
+                    ADMIN_ID[0],
+                    f"<b>💰 Заказ оплачен бонусами!</b>\n\n"
+                    f"Покупка ID: {purchase_id}\n"
+                    f"Пользователь: {user_id or 'Неавторизован'}\n"
+                    f"Товар: {amount} Звёзд ⭐️\n"
+                    f"Получатель: @{recipient_username.lstrip('@')}\n"
+                    f"{bonus_msg}\n"
+                    f"🔄 Начинаем обработку заказа...",
                     parse_mode="HTML"
                 )
-            except Exception as e:
-                logger.error(f"Purchase {purchase_id}: Failed to send admin notification: {str(e)}")
-            # Запускаем обработку
-            asyncio.create_task(process_stars_purchase(purchase_id, "bonus_payment"))
             return jsonify({"purchase_id": purchase_id, "invoice_url": None, "price": 0.0, "bonus_stars_used": bonus_stars_used, "bonus_discount": bonus_discount})
         
         if currency == "USDT":
             # Создаем инвойс, если нужна оплата
-            invoice = await crypto.create_invoice(
-                asset=currency,
-                amount=price,
-                description=f"Purchase of {amount} stars for @{recipient_username}"
-            )
+            with outbound("cryptopay", "createInvoice"):
+                invoice = await crypto.create_invoice(
+                    asset=currency,
+                    amount=price,
+                    description=f"Purchase of {amount} stars for @{recipient_username}"
+                )
             purchase_id = await db.create_purchase(
                 user_id=user_id or 0,
                 item_type="stars",
@@ -320,7 +312,8 @@ async def create_purchase():
                 bonus_discount=bonus_discount
             )
 
-            asyncio.create_task(check_invoice_status(purchase_id, str(invoice.invoice_id)))
+            # Статус инвойса проверяет общий планировщик poll_crypto_invoices
+            track_pending_purchase(purchase_id, invoice_id=str(invoice.invoice_id))
             return jsonify({"purchase_id": purchase_id, "invoice_url": invoice.bot_invoice_url, "price": price, "bonus_stars_used": bonus_stars_used, "bonus_discount": bonus_discount})
         elif currency == "TON":
             unique_comment = f"inv_{uuid4().hex[:16]}"
@@ -340,14 +333,9 @@ async def create_purchase():
             if not purchase_id:
                 raise Exception("Не удалось создать покупку")
             
-            pending_ton_purchases[unique_comment] = purchase_id
-
-            asyncio.create_task(check_invoice_status(purchase_id, unique_comment))
+            # Просроченные TON-счета отменяет poll_crypto_invoices
+            track_pending_purchase(purchase_id, comment=unique_comment)
             
-            # Генерируем QR-код
-            qr_code = await generate_ton_qr_code(TON_WALLET_ADDRESS, price, unique_comment)
-            qr_code_base64 = base64.b64encode(qr_code.getvalue()).decode()
-
             payment_message = (
                 f"💳 Оплата TON\n\n"
                 f"Товар: {amount} Звёзд ⭐️\n"
@@ -368,14 +356,51 @@ async def create_purchase():
                 "price": price,
                 "bonus_stars_used": bonus_stars_used,
                 "bonus_discount": bonus_discount,
-                "qr_code": f"data:image/png;base64,{qr_code_base64}",
+                # QR-код отдается отдельным кэшируемым запросом
+                "qr_code": f"/api/purchase/{purchase_id}/qr?format=png",
+                "qr_code_svg": f"/api/purchase/{purchase_id}/qr?format=svg",
                 "comment": unique_comment,
                 "payment_message": payment_message
             })
+    except InsufficientBonusError:
+        return jsonify({"error": "Недостаточно бонусов, обновите страницу"}), 409
     except Exception as e:
         logger.error(f"Error creating purchase: {str(e)}")
         return jsonify({"error": str(e)}), 500
 
+@api.route("/purchases", methods=["GET"])
+@require_tg_user
+async def get_user_purchases():
+    """
+    История покупок пользователя страницами от новых к старым.
+
+    Только по initData (заголовок X-Telegram-Init-Data): история раскрывает
+    получателей и суммы, поэтому user_id из запроса не принимается.
+    cursor - id последней покупки предыдущей страницы (next_cursor из ответа).
+    ETag считается по содержимому страницы: при совпадении с If-None-Match
+    возвращается 304 без тела.
+    """
+    user_id = g.tg_user["user_id"]
+    cursor = request.args.get("cursor", type=int)
+    limit = min(max(request.args.get("limit", PURCHASES_PAGE_SIZE, type=int), 1), PURCHASES_PAGE_MAX)
+    try:
+        db = current_app.config["DB"]
+        # Лишняя строка показывает, есть ли следующая страница
+        purchases = await db.get_user_purchases(user_id, cursor, limit + 1)
+        next_cursor = purchases[limit - 1]["id"] if len(purchases) > limit else None
+        body = json.dumps({"purchases": purchases[:limit], "next_cursor": next_cursor}, ensure_ascii=False)
+        etag = hashlib.sha1(body.encode()).hexdigest()
+        if request.if_none_match.contains(etag):
+            response = await make_response("", 304)
+        else:
+            response = await make_response(body, {"Content-Type": "application/json"})
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "private, no-cache"
+        return response
+    except Exception as e:
+        logger.error(f"Error getting purchases for user {user_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @api.route("/purchase/<int:purchase_id>", methods=["GET"])
 async def get_purchase(purchase_id):
     """Проверка статуса покупки."""
@@ -395,6 +420,73 @@ async def get_purchase(purchase_id):
         logger.error(f"Error getting purchase status {purchase_id}: {str(e)}")
         return jsonify({"error": str(e)}), 400
 
+@api.route("/purchase/<int:purchase_id>/events", methods=["GET"])
+async def purchase_events(purchase_id):
+    """Поток изменений статуса покупки (Server-Sent Events)."""
+    db = current_app.config["DB"]
+    # Подписываемся до чтения текущего статуса, чтобы не пропустить переход между ними
+    queue = subscribe(purchase_id)
+    purchase = await db.get_purchase_by_id(str(purchase_id))
+    if not purchase:
+        unsubscribe(purchase_id, queue)
+        return jsonify({"error": "Покупка не найдена"}), 404
+
+    async def stream():
+        try:
+            event = {"purchase_id": purchase["id"], "status": purchase["status"], "error_message": purchase["error_message"]}
+            deadline = time.monotonic() + INVOICE_TTL * 2
+            while True:
+                yield f"data: {json.dumps(event)}\n\n".encode()
+                if event["status"] in TERMINAL_STATUSES:
+                    return
+                while True:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return
+                    try:
+                        update = await asyncio.wait_for(queue.get(), min(EVENTS_KEEPALIVE, remaining))
+                    except asyncio.TimeoutError:
+                        yield b": keep-alive\n\n"
+                        continue
+                    # Опросчик БД (helpers.events) может повторить уже отправленный статус
+                    if update["status"] != event["status"]:
+                        event = update
+                        break
+        finally:
+            unsubscribe(purchase_id, queue)
+
+    response = await make_response(stream(), {
+        "Content-Type": "text/event-stream",
+        "Cache-Control": "no-cache",
+        "X-Accel-Buffering": "no"
+    })
+    response.timeout = None  # Поток живет дольше стандартного таймаута ответа
+    return response
+
+@api.route("/purchase/<int:purchase_id>/qr", methods=["GET"])
+async def get_purchase_qr(purchase_id):
+    """QR-код для оплаты ожидающей TON-покупки (format=png|svg)."""
+    image_format = request.args.get("format", "png")
+    if image_format not in QR_MEDIA_TYPES:
+        return jsonify({"error": "Unsupported format"}), 400
+    try:
+        db = current_app.config["DB"]
+        purchase = await db.get_purchase_by_id(str(purchase_id))
+        if not purchase or purchase["currency"] != "TON" or not purchase["comment"]:
+            return jsonify({"error": "Покупка не найдена"}), 404
+        if purchase["status"] != "pending":
+            # Оплата по QR-коду завершенной или отмененной покупки не будет сопоставлена
+            return jsonify({"error": "Покупка не ожидает оплаты"}), 410
+        image = await generate_ton_qr_code(TON_WALLET_ADDRESS, purchase["price"], purchase["comment"], image_format)
+        response = await make_response(image)
+        response.headers["Content-Type"] = QR_MEDIA_TYPES[image_format]
+        # Содержимое QR-кода для покупки не меняется
+        response.headers["Cache-Control"] = f"private, max-age={INVOICE_TTL}, immutable"
+        return response
+    except Exception as e:
+        logger.error(f"Error rendering QR code for purchase {purchase_id}: {str(e)}")
+        return jsonify({"error": str(e)}), 500
+
 @api.route("/support", methods=["GET"])
 def get_support():
     """Получение ссылки на поддержку."""
@@ -404,15 +496,19 @@ def get_support():
 async def get_statistics():
     """Получение статистики отправленных звезд."""
     try:
-        db = current_app.config["DB"]
-        total_stars = await db.get_total_stars_sent()
-        yesterday_stars = await db.get_yesterday_stars_sent()
-        today_stars = await db.get_today_stars_sent()
-        return jsonify({
-            "total_stars_sent": total_stars,
-            "yesterday_stars_sent": yesterday_stars,
-            "today_stars_sent": today_stars
-        })
+        now = time.monotonic()
+        if _statistics_cache["data"] is None or now >= _statistics_cache["expires_at"]:
+            db = current_app.config["DB"]
+            stats = await db.get_stars_statistics()
+            _statistics_cache["data"] = {
+                "total_stars_sent": stats["total"],
+                "yesterday_stars_sent": stats["yesterday"],
+                "today_stars_sent": stats["today"]
+            }
+            _statistics_cache["expires_at"] = now + STATISTICS_CACHE_TTL
+        response = jsonify(_statistics_cache["data"])
+        response.headers["Cache-Control"] = f"public, max-age={STATISTICS_CACHE_TTL}"
+        return response
     except Exception as e:
         logger.error(f"Error getting statistics: {str(e)}")
         return jsonify({"error": str(e)}), 500
\ No newline at end of file
@@ -1,4 +1,5 @@
 from quart import Blueprint, render_template
+from helpers.metrics import render
 
 web = Blueprint("web", __name__)
 
@@ -10,6 +11,11 @@ async def index():
 async def support():
     return await render_template("support.html")
 
+@web.route("/metrics")
+async def metrics():
+    """Метрики процесса в формате Prometheus (при нескольких воркерах - только этого воркера)"""
+    return render(), 200, {"Content-Type": "text/plain; version=0.0.4; charset=utf-8"}
+
 # @web.route("/test")
 # async def test():
 #     return await render_template("telegram_webapp_test.html")
\ No newline at end of file
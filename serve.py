@@ -0,0 +1,30 @@
+"""
+Production-запуск: Hypercorn с WEB_WORKERS процессами на WEB_BIND.
+
+HTTP обслуживает каждый воркер, фоновые опросчики - только владелец
+блокировки LEADER_LOCK_PATH (см. helpers/leader.py).
+Статусы покупок меняет лидер, поэтому SSE-потоки остальных воркеров
+узнают о них из БД: один запрос на процесс раз в EVENTS_RESYNC_INTERVAL секунд.
+
+Запуск: WEB_WORKERS=2 python serve.py
+Для разработки по-прежнему: python app.py
+"""
+import importlib.util
+from hypercorn.config import Config
+from hypercorn.run import run
+from config import WEB_BIND, WEB_WORKERS
+
+def build_config() -> Config:
+    config = Config()
+    config.application_path = "app:app"
+    config.bind = [WEB_BIND]
+    config.workers = WEB_WORKERS
+    # uvloop, если установлен; иначе стандартный цикл asyncio
+    config.worker_class = "uvloop" if importlib.util.find_spec("uvloop") else "asyncio"
+    config.accesslog = None  # Журнал запросов ведет обратный прокси
+    config.errorlog = "logs/hypercorn.log"
+    config.graceful_timeout = 10  # Время на завершение SSE-потоков и фоновых задач
+    return config
+
+if __name__ == "__main__":
+    run(build_config())
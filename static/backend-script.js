@@ -27,6 +27,9 @@ notification.style.zIndex = '1000';
 let prices = {};
 let purchaseId = null;
 let currentUserId = null;
+let recipientCheck = { username: null, valid: null, error: null };
+let recipientTimer = null;
+const RECIPIENT_DEBOUNCE = 400;
 
 // Функция отображения уведомлений
 function showNotification(message, type) {
@@ -39,34 +42,116 @@ function showNotification(message, type) {
     }, 5000);
 }
 
-// Функция обновления стоимости
-function updatePrice() {
+// Котировка: цены за 1 звезду и бонусный баланс, стоимость считается на клиенте
+const QUOTE_REFRESH_MARGIN = 10000;  // Запрашиваем новую котировку за 10 секунд до истечения
+const PRICE_DEBOUNCE = 250;
+let quote = null;
+let quoteRequest = null;
+let priceTimer = null;
+
+function currentBuyerId() {
+    return window.Telegram?.WebApp?.initData ? currentUserId : getCookie("user_id") || null;
+}
+
+function fetchQuote() {
+    if (!quoteRequest) {
+        quoteRequest = fetch('/api/quote', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({
+                initData: window.Telegram?.WebApp?.initData || null,
+                user_id: currentBuyerId()
+            })
+        })
+            .then(response => response.json())
+            .then(data => {
+                if (data.error) {
+                    throw new Error(data.error);
+                }
+                quote = { ...data, expiresAt: Date.now() + data.expires_in * 1000 };
+            })
+            .finally(() => quoteRequest = null);
+    }
+    return quoteRequest;
+}
+
+function quoteValid() {
+    return quote && quote.expiresAt - Date.now() > QUOTE_REFRESH_MARGIN;
+}
+
+// Стоимость с учетом бонусной скидки (та же формула, что и в /api/prices)
+function renderPrice() {
     const amount = Number(quantityInput2.value) || 50;
     const currency = currencySelect.value;
-    fetch('/api/prices', {
-        method: 'POST',
-        headers: { 'Content-Type': 'application/json' },
-        body: JSON.stringify({
-            initData: window.Telegram?.WebApp?.initData || null,
-            user_id: window.Telegram?.WebApp?.initData ? currentUserId : getCookie("user_id") || null,
-            amount: amount
-        })
-    })
-        .then(response => response.json())
-        .then(data => {
-            if (data.error) {
-                showNotification(`Ошибка загрузки цен`, 'error');
-                return;
-            }
-            prices = data;
-            costOutput.textContent = prices[currency] ? prices[currency].discounted.toFixed(6) : '0';
-            currencyOutput.textContent = currency;
-            buyButtonStars.textContent = amount;
-            buyBtn.textContent = `Купить ${amount} звёзд`;
-        })
+    prices = {};
+    for (const [code, pricePerStar] of Object.entries(quote.prices)) {
+        const original = amount * pricePerStar;
+        const discount = Math.min(quote.bonus_balance * pricePerStar, original);
+        prices[code] = { original, discounted: Math.max(0, original - discount) };
+    }
+    costOutput.textContent = prices[currency] ? prices[currency].discounted.toFixed(6) : '0';
+    currencyOutput.textContent = currency;
+    buyButtonStars.textContent = amount;
+    buyBtn.textContent = `Купить ${amount} звёзд`;
+}
+
+// Функция обновления стоимости: сеть нужна только для новой котировки
+function updatePrice() {
+    clearTimeout(priceTimer);
+    if (quoteValid()) {
+        renderPrice();
+        return;
+    }
+    fetchQuote()
+        .then(renderPrice)
         .catch(() => showNotification('Ошибка загрузки цен', 'error'));
 }
 
+// Ввод с клавиатуры пересчитывается после паузы
+function schedulePriceUpdate() {
+    clearTimeout(priceTimer);
+    priceTimer = setTimeout(updatePrice, PRICE_DEBOUNCE);
+}
+
+// Котировка сбрасывается, когда меняется пользователь или его бонусный баланс
+function refreshQuote() {
+    quote = null;
+    updatePrice();
+}
+
+// Проверка получателя при вводе username
+function recipientName() {
+    return userInput.value.trim().replace(/^@/, '');
+}
+
+function checkRecipient() {
+    const username = recipientName();
+    clearTimeout(recipientTimer);
+    recipientCheck = { username, valid: null, error: null };
+    userInput.style.borderColor = '';
+    userInput.title = '';
+    if (!username) {
+        return;
+    }
+    recipientTimer = setTimeout(() => {
+        fetch(`/api/recipient/${encodeURIComponent(username)}`)
+            .then(response => response.json())
+            .then(data => {
+                if (recipientName() !== username) {
+                    return;  // Ввод уже изменился
+                }
+                recipientCheck = { username, valid: data.valid, error: data.error };
+                if (data.valid === false) {
+                    userInput.style.borderColor = '#dc3545';
+                    userInput.title = data.error;
+                } else if (data.valid) {
+                    userInput.style.borderColor = '#28a745';
+                }
+            })
+            .catch(() => {});
+    }, RECIPIENT_DEBOUNCE);
+}
+
 function getCookie(name) {
     const cookies = document.cookie.split(';').map(cookie => cookie.trim());
     for (const cookie of cookies) {
@@ -99,7 +184,7 @@ if (initData) {
                     userName.textContent = data.fullname;
                     telegramAuthButton.style.display = 'none';
                 }
-                updatePrice();
+                refreshQuote();
             } else {
                 showNotification(`Ошибка авторизации`, 'error');
                 updatePrice();
@@ -128,7 +213,7 @@ if (initData) {
                         userName.textContent = data.fullname || data.username;
                         telegramAuthButton.style.display = 'none';
                     }
-                    updatePrice();
+                    refreshQuote();
                     // Очищаем URL
                     window.history.replaceState({}, document.title, window.location.pathname);
                 } else {
@@ -165,6 +250,10 @@ async function buyStars() {
         showNotification('Заполните все поля', 'error');
         return;
     }
+    if (recipientCheck.valid === false && recipientCheck.username === recipientName()) {
+        showNotification(recipientCheck.error || 'Пользователь не найден', 'error');
+        return;
+    }
     try {
         const response = await fetch('/api/purchase', {
             method: 'POST',
@@ -173,11 +262,15 @@ async function buyStars() {
                 amount,
                 recipient_username: username,
                 currency,
-                user_id: window.Telegram?.WebApp?.initData ? currentUserId : getCookie("user_id") || null
+                user_id: currentBuyerId(),
+                quote_id: quoteValid() ? quote.quote_id : null
             })
         });
         const data = await response.json();
         if (data.error) {
+            if (response.status === 400 && data.error.startsWith('Quote')) {
+                refreshQuote();
+            }
             showNotification('Ошибка при создании покупки', 'error');
         } else {
             purchaseId = data.purchase_id;
@@ -198,44 +291,63 @@ async function buyStars() {
     }
 }
 
-// Проверка статуса покупки
+// Отображение статуса покупки, возвращает true для конечных статусов
+function handlePurchaseStatus(data) {
+    if (data.error) {
+        statusOutput.textContent = `Ошибка`;
+        showNotification(`Ошибка`, 'error');
+    } else if (data.status === 'completed') {
+        statusOutput.textContent = 'Покупка завершена!';
+        showNotification('Покупка успешно завершена!', 'success');
+        quantityInput2.value = '';
+        userInput.value = userInput.value;
+        currencySelect.value = 'TON';
+        refreshQuote();
+    } else if (data.status === 'failed') {
+        statusOutput.textContent = `Ошибка: свяжитесь с поддержкой: https://t.me/HappySupportStars`;
+        showNotification(`Ошибка: свяжитесь с поддержкой: https://t.me/HappySupportStars`, 'error');
+    } else if (data.status === 'cancelled') {
+        statusOutput.textContent = 'Оплата не произошла в течение 15 минут, счет отменен.';
+        showNotification('Оплата не произошла в течение 15 минут, счет отменен.', 'error');
+    } else {
+        return false;
+    }
+    document.getElementById('payment-block').style.display = 'none';
+    document.getElementById('payment-message').textContent = '';
+    document.getElementById('payment-qr').src = '';
+    return true;
+}
+
+// Проверка статуса покупки: сервер присылает изменения через SSE
 function checkPurchaseStatus(purchaseId) {
+    if (!window.EventSource) {
+        pollPurchaseStatus(purchaseId);
+        return;
+    }
+    const events = new EventSource(`/api/purchase/${purchaseId}/events`);
+    let finished = false;
+    events.onmessage = (event) => {
+        if (handlePurchaseStatus(JSON.parse(event.data))) {
+            finished = true;
+            events.close();
+        }
+    };
+    events.onerror = () => {
+        // Браузер сам переподключается; если соединение закрыто окончательно - переходим на опрос
+        if (!finished && events.readyState === EventSource.CLOSED) {
+            pollPurchaseStatus(purchaseId);
+        }
+    };
+}
+
+// Запасной вариант: опрос статуса каждые 5 секунд
+function pollPurchaseStatus(purchaseId) {
     const interval = setInterval(() => {
         fetch(`/api/purchase/${purchaseId}`)
             .then(response => response.json())
             .then(data => {
-                if (data.error) {
-                    statusOutput.textContent = `Ошибка`;
-                    showNotification(`Ошибка`, 'error');
-                    clearInterval(interval);
-                    document.getElementById('payment-block').style.display = 'none';
-                    document.getElementById('payment-message').textContent = '';
-                    document.getElementById('payment-qr').src = '';
-                } else if (data.status === 'completed') {
-                    statusOutput.textContent = 'Покупка завершена!';
-                    showNotification('Покупка успешно завершена!', 'success');
+                if (handlePurchaseStatus(data)) {
                     clearInterval(interval);
-                    document.getElementById('payment-block').style.display = 'none';
-                    document.getElementById('payment-message').textContent = '';
-                    document.getElementById('payment-qr').src = '';
-                    quantityInput2.value = '';
-                    userInput.value = userInput.value;
-                    currencySelect.value = 'TON';
-                    updatePrice();
-                } else if (data.status === 'failed') {
-                    statusOutput.textContent = `Ошибка: свяжитесь с поддержкой: https://t.me/HappySupportStars`;
-                    showNotification(`Ошибка: свяжитесь с поддержкой: https://t.me/HappySupportStars`, 'error');
-                    clearInterval(interval);
-                    document.getElementById('payment-block').style.display = 'none';
-                    document.getElementById('payment-message').textContent = '';
-                    document.getElementById('payment-qr').src = '';
-                } else if (data.status === 'cancelled') {
-                    statusOutput.textContent = 'Оплата не произошла в течение 15 минут, счет отменен.';
-                    showNotification('Оплата не произошла в течение 15 минут, счет отменен.', 'error');
-                    clearInterval(interval);
-                    document.getElementById('payment-block').style.display = 'none';
-                    document.getElementById('payment-message').textContent = '';
-                    document.getElementById('payment-qr').src = '';
                 }
             })
             .catch(() => {
@@ -282,7 +394,7 @@ quantityInput2.addEventListener('input', () => {
     if (quantity) {
         starsOptions.forEach(option => option.checked = false);
     }
-    updatePrice();
+    schedulePriceUpdate();
 });
 
 starsOptions.forEach(option => {
@@ -293,4 +405,5 @@ starsOptions.forEach(option => {
 });
 
 currencySelect.addEventListener('change', updatePrice);
+userInput.addEventListener('input', checkRecipient);
 buyBtn.addEventListener('click', buyStars);
\ No newline at end of file